@@ -1,20 +1,37 @@
 import os
-import json
+import hashlib
 import sqlite3
+import ssl
 import re
 import requests
 import threading
 import time
-
+import queue
+import math
+import operator
+import orjson
+import httpx
+import schedule
+
+from array import array
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
 from datetime import datetime, timedelta
+from functools import lru_cache
+from cachetools import TTLCache
 from flask import Flask, request, abort
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import InvalidSignatureError, LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import (
     MessageEvent, TextMessage, ImageMessage, TextSendMessage,
     QuickReply, QuickReplyButton, MessageAction
 )
 from dotenv import load_dotenv
+from openai import OpenAI, OpenAIError
+from requests.adapters import HTTPAdapter
 
 # 載入環境變數
 load_dotenv()
@@ -26,18 +43,411 @@ LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 
+# LINE API 共用的 requests Session，回覆與推播可重複使用 TCP/TLS 連線
+LINE_HTTP_SESSION = requests.Session()
+LINE_HTTP_SESSION.mount('https://', HTTPAdapter(pool_connections=50, pool_maxsize=100))
+
+class SessionHttpClient(RequestsHttpClient):
+    """改用共用 Session 發送請求的 LINE HTTP client（預設每次呼叫都開新連線）"""
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = LINE_HTTP_SESSION.get(
+            url, headers=headers, params=params, stream=stream,
+            timeout=self.timeout if timeout is None else timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = LINE_HTTP_SESSION.post(
+            url, headers=headers, data=data,
+            timeout=self.timeout if timeout is None else timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = LINE_HTTP_SESSION.delete(
+            url, headers=headers, data=data,
+            timeout=self.timeout if timeout is None else timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = LINE_HTTP_SESSION.put(
+            url, headers=headers, data=data,
+            timeout=self.timeout if timeout is None else timeout
+        )
+        return RequestsHttpResponse(response)
+
 # 初始化
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, http_client=SessionHttpClient)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
+# LINE 推播專用執行緒池：回覆內容產生後，推播的 HTTPS 往返不必佔住處理中的執行緒
+_SEND_POOL = ThreadPoolExecutor(max_workers=32)
+
+def push_in_background(user_id, messages):
+    """把 push_message 交給推播執行緒池，回傳 Future（失敗只記錄，不會拋出）"""
+    def _send():
+        try:
+            line_bot_api.push_message(user_id, messages)
+        except Exception as e:
+            print(f"❌ 推播失敗（{user_id}）：{e}")
+    return _SEND_POOL.submit(_send)
+
+# reply token 約 1 分鐘內有效，保留一些緩衝
+REPLY_TOKEN_TTL = 50
+
+def reply_or_push(event, messages):
+    """優先用 reply token 回覆（不佔推播額度），token 逾時或已失效才改用推播
+
+    改用推播時回傳推播的 Future，需要維持訊息順序的呼叫端可等待它完成。
+    """
+    timestamp = getattr(event, 'timestamp', None)
+    # reply token 只能使用一次，用過就清掉，之後的訊息直接推播，不必多打一次必定失敗的 API
+    if event.reply_token and (timestamp is None or time.time() - timestamp / 1000 < REPLY_TOKEN_TTL):
+        try:
+            line_bot_api.reply_message(event.reply_token, messages)
+            event.reply_token = None
+            return None
+        except LineBotApiError as e:
+            print(f"⚠️ reply token 無法使用，改用推播：{e}")
+    return push_in_background(event.source.user_id, messages)
+
+# OpenAI 客戶端只建立一次，重複使用底層 HTTP 連線（未設定金鑰時各功能會改用備用內容）
+# SSL context 與 httpx 連線池也只建立一次，TCP/TLS 握手可在各次 webhook 間共用
+OPENAI_HTTP_CLIENT = httpx.Client(
+    verify=ssl.create_default_context(),
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    timeout=30.0
+)
+# 連線錯誤、逾時、429 與 5xx 由 SDK 以指數退避自動重試；2 次即 SDK 預設值，
+# 明確寫出只是為了計算下方的最長等待時間，並未增加重試
+OPENAI_SDK_MAX_RETRIES = 2
+
+# 要回覆用戶的對話請求使用較短的逾時（預設 30 秒），避免單次卡住就用掉整個 reply token 有效期；
+# 3 次嘗試都逾時的最壞情況（約 36 秒加上退避）仍可能超過 REPLY_TOKEN_TTL，此時 reply_or_push 會改用推播
+CHAT_REQUEST_TIMEOUT = 12.0
+
+# 等待背景 GPT 結果的上限：每次嘗試的逾時乘上嘗試次數，超過就改用備用內容
+CHAT_RESULT_TIMEOUT = CHAT_REQUEST_TIMEOUT * (OPENAI_SDK_MAX_RETRIES + 1)
+OPENAI_CLIENT = OpenAI(
+    api_key=OPENAI_API_KEY, http_client=OPENAI_HTTP_CLIENT, max_retries=OPENAI_SDK_MAX_RETRIES
+) if OPENAI_API_KEY else None
+
+# 對話模型：gpt-4o-mini 比 gpt-3.5-turbo 便宜且回應更快；可用 OPENAI_CHAT_MODEL 切換模型做比較
+CHAT_MODEL = os.getenv('OPENAI_CHAT_MODEL', "gpt-4o-mini")
+
+def require_openai_client():
+    """取得 OpenAI 客戶端；未設定金鑰時拋出 OpenAIError，讓呼叫端改用備用內容"""
+    if OPENAI_CLIENT is None:
+        raise OpenAIError("未設定 OPENAI_API_KEY")
+    return OPENAI_CLIENT
+
+# 背景工作執行緒池：耗時的 OpenAI 呼叫在此執行，完成後再回覆用戶
+EXECUTOR = ThreadPoolExecutor(max_workers=16)
+
+def run_in_background(func, *args):
+    """把需要呼叫 OpenAI 的處理交給背景執行緒，webhook 可立即回應 LINE"""
+    def _run():
+        try:
+            func(*args)
+        except Exception as e:
+            # 背景執行緒的例外不會傳回 webhook，這裡記錄下來避免被 Future 吞掉
+            print(f"❌ 背景處理失敗（{func.__name__}）：{e}")
+    return EXECUTOR.submit(_run)
+
+class BatchQueue:
+    """合併短時間內送出的 GPT 請求
+
+    收集 window 秒內（最多 max_batch 筆）的請求，完全相同的請求只呼叫一次 API，
+    結果分送給所有等待的 Future；不同的請求則並行送出，共用同一個 HTTP 連線池。
+    """
+
+    def __init__(self, window=0.05, max_batch=8, workers=8):
+        self.window = window
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, **req):
+        """送出 chat.completions 請求，回傳之後可取得 response 的 Future"""
+        future = Future()
+        self._ensure_started()
+        self._queue.put((req, future))
+        return future
+
+    def _ensure_started(self):
+        # 第一次使用時才啟動，避免 fork 之前就建立執行緒
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._flush_loop, daemon=True)
+                self._thread.start()
+
+    def _flush_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # 相同的請求合併成一次呼叫
+            groups = {}
+            for req, future in batch:
+                key = orjson.dumps(req, option=orjson.OPT_SORT_KEYS)
+                groups.setdefault(key, (req, []))[1].append(future)
+            if len(batch) > len(groups):
+                print(f"🔗 合併 GPT 請求：{len(batch)} 筆 → {len(groups)} 次呼叫")
+
+            for req, futures in groups.values():
+                self._pool.submit(self._dispatch, req, futures)
+
+    @staticmethod
+    def _dispatch(req, futures):
+        try:
+            response = require_openai_client().chat.completions.create(**req)
+        except Exception as e:
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future in futures:
+            future.set_result(response)
+
+# 不需串流的 GPT 呼叫（飲食分析、週報告）共用的批次佇列
+GPT_BATCH = BatchQueue()
+
+# 串流回覆的段落標記（Prompt 要求各段落以這些 emoji 開頭）
+STREAM_SECTION_MARKERS = ("🍽️", "💡", "🔍")
+
+# 回答沒有段落標記時，累積到這個長度就在最近的空行先送出第一段
+STREAM_FIRST_SECTION_MIN_CHARS = 200
+
+def _next_section_start(text):
+    """回傳第二個段落的起始位置，尚未出現時回傳 0"""
+    positions = [text.find(marker, 1) for marker in STREAM_SECTION_MARKERS]
+    positions = [pos for pos in positions if pos > 0]
+    if positions:
+        return min(positions)
+    if len(text) >= STREAM_FIRST_SECTION_MIN_CHARS:
+        paragraph_end = text.rfind("\n\n")
+        if paragraph_end > 0:
+            return paragraph_end + 2
+    return 0
+
+def stream_chat_completion(on_first_section, **req):
+    """以串流方式呼叫 GPT
+
+    第一個段落一完成就交給 on_first_section 先送出，之後繼續累積，
+    回傳 (完整內容, 已送出的字數)。
+    """
+    started = time.monotonic()
+    stream = require_openai_client().chat.completions.create(stream=True, **req)
+    content = ""
+    sent = 0
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if not delta:
+            continue
+        if not content:
+            print(f"⏱️ GPT 首個 token：{(time.monotonic() - started) * 1000:.0f} ms")
+        content += delta
+        if not sent:
+            cut = _next_section_start(content)
+            if cut:
+                on_first_section(content[:cut].rstrip())
+                sent = cut
+    return content, sent
+
+def stream_to_line(event, prefix, fallback, **req):
+    """串流呼叫 GPT 並回覆用戶：第一個段落先用 reply 送出，其餘內容完成後一次推播
+
+    GPT 失敗時改送 fallback() 產生的備用內容並回傳 None；成功時回傳完整內容供快取使用。
+    """
+    first_section_sent = False
+    first_section_push = None
+
+    def send_first_section(section):
+        nonlocal first_section_sent, first_section_push
+        first_section_push = reply_or_push(event, TextSendMessage(text=f"{prefix}{section}"))
+        first_section_sent = True
+
+    def push_after_first_section(text):
+        # 第一段若也是推播，等它送出再推播，維持訊息順序
+        if first_section_push is not None:
+            first_section_push.result()
+        push_in_background(event.source.user_id, TextSendMessage(text=text))
+
+    try:
+        content, sent = stream_chat_completion(send_first_section, **req)
+    except (OpenAIError, httpx.HTTPError) as openai_error:
+        # 串流途中斷線時 httpx 的錯誤會直接拋出，不一定包成 OpenAIError
+        print(f"⚠️ GPT 呼叫失敗，改用備用內容：{openai_error}")
+        # 已送出第一段時，備用內容只能改用推播
+        if first_section_sent:
+            push_after_first_section(fallback())
+        else:
+            reply_or_push(event, TextSendMessage(text=f"{prefix}{fallback()}"))
+        return None
+
+    if sent:
+        remainder = content[sent:].strip()
+        if remainder:
+            push_after_first_section(remainder)
+    else:
+        reply_or_push(event, TextSendMessage(text=f"{prefix}{content}"))
+    return content
+
 # 用戶狀態管理
-user_states = {}
+class LockedTTLCache(TTLCache):
+    """加上鎖的 TTLCache，讓多個 webhook 執行緒可以安全共用"""
+
+    def __init__(self, maxsize, ttl):
+        self._lock = threading.RLock()
+        super().__init__(maxsize=maxsize, ttl=ttl)
+
+    def __getitem__(self, key):
+        with self._lock:
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            super().__delitem__(key)
+
+    def __contains__(self, key):
+        with self._lock:
+            return super().__contains__(key)
+
+    def get(self, key, default=None):
+        with self._lock:
+            return super().get(key, default)
+
+    def pop(self, key, *args):
+        with self._lock:
+            return super().pop(key, *args)
+
+# 閒置 30 分鐘的對話狀態會自動清除，避免一次性用戶的狀態永久佔用記憶體
+user_states = LockedTTLCache(maxsize=10000, ttl=1800)
+
+# 資料庫頁面大小（較符合營養記錄的資料列大小）
+DB_PAGE_SIZE = 8192
+
+def get_db_connection(timeout=5.0, check_same_thread=True):
+    """建立資料庫連線，並套用讀取效能相關的 PRAGMA 設定"""
+    conn = sqlite3.connect('nutrition_bot.db', timeout=timeout, check_same_thread=check_same_thread)
+    conn.execute('PRAGMA mmap_size = 268435456')  # 256MB，讀取直接走記憶體映射
+    conn.execute('PRAGMA cache_size = -32000')  # 約 32MB 頁面快取
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+
+class DBPool:
+    """SQLite 連線池：連線只開啟一次，之後在各個 webhook 請求間重複使用"""
+
+    def __init__(self, size=8, timeout=5.0):
+        self.size = size
+        self.timeout = timeout
+        self._pool = queue.Queue(maxsize=size)
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _create_connection(self):
+        conn = get_db_connection(timeout=self.timeout, check_same_thread=False)
+        # 自動提交模式：需要多個語句一起寫入時，以 BEGIN IMMEDIATE / COMMIT 明確包成一個交易
+        conn.isolation_level = None
+        conn.row_factory = sqlite3.Row  # 以欄位名稱取值，不受欄位順序影響
+        # WAL 讓讀取與寫入可同時進行；NORMAL 在 WAL 下只在 checkpoint 時 fsync
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.timeout * 1000)}')
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        # 尚未達到上限時才建立新連線
+        with self._lock:
+            if self._created < self.size:
+                conn = self._create_connection()
+                self._created += 1
+                print(f"🔌 DB 連線池建立新連線（{self._created}/{self.size}）")
+                return conn
+
+        # 連線全部使用中，等待歸還
+        wait_start = time.monotonic()
+        conn = self._pool.get()
+        print(f"⏳ DB 連線池已滿，等待 {time.monotonic() - wait_start:.3f} 秒後取得連線")
+        return conn
+
+    @contextmanager
+    def get_conn(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            # 歸還前確保沒有未結束的交易，避免持有寫入鎖
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+
+# 全域連線池
+DB_POOL = DBPool(size=8)
+
+# 用戶資料快取（LRU），只快取 users 資料列；每日營養總計會頻繁變動，不放入快取
+USER_CACHE_MAXSIZE = 4096
+_USER_CACHE = OrderedDict()
+_USER_CACHE_LOCK = threading.Lock()
+
+# 資料庫 schema 版本（存於 PRAGMA user_version），新增欄位或索引時請遞增
+SCHEMA_VERSION = 3
+
+# 用戶表後續新增的欄位
+USER_MIGRATION_COLUMNS = (
+    ('body_fat_percentage', 'REAL DEFAULT 0'),
+    ('diabetes_type', 'TEXT'),
+    ('target_calories', 'REAL DEFAULT 2000'),
+    ('target_carbs', 'REAL DEFAULT 250'),
+    ('target_protein', 'REAL DEFAULT 100'),
+    ('target_fat', 'REAL DEFAULT 70'),
+    ('bmr', 'REAL DEFAULT 1500'),
+    ('tdee', 'REAL DEFAULT 2000'),
+    ('last_active', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
+    ('last_reminder_sent', 'TIMESTAMP'),
+    ('last_profile_update', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
+    ('visceral_fat_level', 'INTEGER DEFAULT 0'),
+    ('muscle_mass', 'REAL DEFAULT 0'),
+)
+
+# 飲食記錄表的營養素欄位
+MEAL_NUTRITION_COLUMNS = (
+    ('calories', 'REAL DEFAULT 0'),
+    ('carbs', 'REAL DEFAULT 0'),
+    ('protein', 'REAL DEFAULT 0'),
+    ('fat', 'REAL DEFAULT 0'),
+    ('fiber', 'REAL DEFAULT 0'),
+    ('sugar', 'REAL DEFAULT 0'),
+)
 
 # 資料庫初始化
 def init_db():
     conn = None
     try:
-        conn = sqlite3.connect('nutrition_bot.db', timeout=20.0)
+        conn = get_db_connection(timeout=20.0)
         cursor = conn.cursor()
     
         # 用戶資料表
@@ -70,55 +480,6 @@ def init_db():
             )
         ''')
         
-        # 添加用戶表的新欄位
-        user_columns = [
-            ('body_fat_percentage', 'REAL DEFAULT 0'),
-            ('diabetes_type', 'TEXT'),
-            ('target_calories', 'REAL DEFAULT 2000'),
-            ('target_carbs', 'REAL DEFAULT 250'),
-            ('target_protein', 'REAL DEFAULT 100'),
-            ('target_fat', 'REAL DEFAULT 70'),
-            ('bmr', 'REAL DEFAULT 1500'),
-            ('tdee', 'REAL DEFAULT 2000'),
-            ('last_active', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
-            ('last_reminder_sent', 'TIMESTAMP'),
-            ('last_profile_update', 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP'),
-            ('visceral_fat_level', 'INTEGER DEFAULT 0'),
-            ('muscle_mass', 'REAL DEFAULT 0')
-        ]
-
-
-        
-        for column_name, column_type in user_columns:
-            try:
-                cursor.execute(f'ALTER TABLE users ADD COLUMN {column_name} {column_type}')
-                print(f"已添加用戶欄位：{column_name}")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    pass  # 欄位已存在，忽略
-                else:
-                    print(f"添加用戶欄位 {column_name} 時發生錯誤：{e}")
-        
-        # 添加新的營養素欄位（如果不存在）
-        nutrition_columns = [
-            ('calories', 'REAL DEFAULT 0'),
-            ('carbs', 'REAL DEFAULT 0'),
-            ('protein', 'REAL DEFAULT 0'),
-            ('fat', 'REAL DEFAULT 0'),
-            ('fiber', 'REAL DEFAULT 0'),
-            ('sugar', 'REAL DEFAULT 0')
-        ]
-
-        for column_name, column_type in nutrition_columns:
-            try:
-                cursor.execute(f'ALTER TABLE meal_records ADD COLUMN {column_name} {column_type}')
-                print(f"已添加欄位：{column_name}")
-            except sqlite3.OperationalError as e:
-                if "duplicate column name" in str(e):
-                    print(f"欄位 {column_name} 已存在")
-                else:
-                    print(f"添加欄位 {column_name} 時發生錯誤：{e}")
-        
         # 飲食記錄表
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS meal_records (
@@ -163,6 +524,68 @@ def init_db():
             )
         ''')
         
+        # 依 schema 版本決定是否需要補欄位，已是最新版本時只需一次 PRAGMA 讀取
+        cursor.execute("PRAGMA user_version")
+        schema_version = cursor.fetchone()[0]
+        
+        # 版本 1：補齊用戶表與飲食記錄表的新欄位
+        if schema_version < 1:
+            # 添加用戶表的新欄位（只對缺少的欄位執行 ALTER）
+            cursor.execute("PRAGMA table_info(users)")
+            existing_user_columns = {column[1] for column in cursor.fetchall()}
+            for column_name, column_type in USER_MIGRATION_COLUMNS:
+                if column_name not in existing_user_columns:
+                    cursor.execute(f'ALTER TABLE users ADD COLUMN {column_name} {column_type}')
+                    print(f"已添加用戶欄位：{column_name}")
+            
+            # 添加新的營養素欄位（如果不存在）
+            cursor.execute("PRAGMA table_info(meal_records)")
+            existing_meal_columns = {column[1] for column in cursor.fetchall()}
+            for column_name, column_type in MEAL_NUTRITION_COLUMNS:
+                if column_name not in existing_meal_columns:
+                    cursor.execute(f'ALTER TABLE meal_records ADD COLUMN {column_name} {column_type}')
+                    print(f"已添加欄位：{column_name}")
+        
+        # 版本 2：合併重複的食物偏好記錄，並建立 (user_id, food_item) 唯一索引供 UPSERT 使用
+        if schema_version < 2:
+            cursor.execute('''
+                UPDATE food_preferences SET
+                    frequency = (SELECT SUM(fp.frequency) FROM food_preferences fp
+                                 WHERE fp.user_id = food_preferences.user_id
+                                 AND fp.food_item = food_preferences.food_item),
+                    last_eaten = (SELECT MAX(fp.last_eaten) FROM food_preferences fp
+                                  WHERE fp.user_id = food_preferences.user_id
+                                  AND fp.food_item = food_preferences.food_item)
+                WHERE id IN (SELECT MIN(id) FROM food_preferences
+                             GROUP BY user_id, food_item HAVING COUNT(*) > 1)
+            ''')
+            cursor.execute('''
+                DELETE FROM food_preferences WHERE id NOT IN (
+                    SELECT MIN(id) FROM food_preferences GROUP BY user_id, food_item
+                )
+            ''')
+            cursor.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_food_preferences_user_item
+                ON food_preferences (user_id, food_item)
+            ''')
+            print("✅ 已建立 food_preferences 唯一索引")
+        
+        # 版本 3：查詢用的複合索引，讓依用戶篩選與排序可直接由索引完成
+        if schema_version < 3:
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS ix_meal_user_time
+                ON meal_records (user_id, recorded_at DESC)
+            ''')
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS ix_foodpref_user_freq
+                ON food_preferences (user_id, frequency DESC, last_eaten DESC)
+            ''')
+            print("✅ 已建立 meal_records / food_preferences 查詢索引")
+        
+        if schema_version < SCHEMA_VERSION:
+            cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            print(f"✅ 資料庫 schema 已更新至版本 {SCHEMA_VERSION}")
+        
         conn.commit()
         print("資料庫初始化成功")
         
@@ -177,301 +600,499 @@ def init_db():
 # 初始化資料庫
 init_db()
 
+def _meal_records_has_nutrition_columns():
+    """啟動時讀取一次 meal_records 結構，確認營養素欄位是否齊全"""
+    conn = None
+    try:
+        # 不使用連線池，避免啟動階段就佔住 WAL 連線而無法調整頁面大小
+        conn = get_db_connection()
+        columns = {column[1] for column in conn.execute("PRAGMA table_info(meal_records)")}
+        return all(column_name in columns for column_name, _ in MEAL_NUTRITION_COLUMNS)
+    except Exception as e:
+        print(f"❌ 檢查 meal_records 欄位失敗：{e}")
+        return False
+    finally:
+        if conn:
+            conn.close()
+
+# init_db 完成後欄位不會再變動，結果快取供每次寫入使用
+MEAL_RECORDS_HAS_NUTRITION_COLS = _meal_records_has_nutrition_columns()
+
+@dataclass(frozen=True, slots=True)
+class UserProfile:
+    """已套用預設值的用戶資料，以屬性存取取代反覆的 dict 查詢"""
+    user_id: str
+    name: str
+    age: int
+    gender: str
+    height: float
+    weight: float
+    bmi: float
+    activity_level: str
+    health_goals: str
+    dietary_restrictions: str
+    created_at: str
+    updated_at: str
+    body_fat_percentage: float
+    diabetes_type: str
+    target_calories: float
+    target_carbs: float
+    target_protein: float
+    target_fat: float
+    bmr: float
+    tdee: float
+    last_active: str
+    last_reminder_sent: str
+    last_profile_update: str
+    visceral_fat_level: float
+    muscle_mass: float
+
+def _build_user_profile(user):
+    # 連線池使用 sqlite3.Row，直接以欄位名稱取值；0 有意義的欄位（未填寫）才保留原值
+    body_fat_percentage = user['body_fat_percentage']
+    visceral_fat_level = user['visceral_fat_level']
+    muscle_mass = user['muscle_mass']
+    height = user['height'] or 170
+    weight = user['weight'] or 70
+    
+    return UserProfile(
+        user_id=user['user_id'],
+        name=user['name'] or "用戶",
+        age=user['age'] or 30,
+        gender=user['gender'] or "未設定",
+        height=height,
+        weight=weight,
+        bmi=weight / ((height / 100) ** 2),
+        activity_level=user['activity_level'] or "中等活動量",
+        health_goals=user['health_goals'] or "維持健康",
+        dietary_restrictions=user['dietary_restrictions'] or "無",
+        created_at=user['created_at'],
+        updated_at=user['updated_at'],
+        body_fat_percentage=body_fat_percentage if body_fat_percentage is not None else 20.0,
+        diabetes_type=user['diabetes_type'],
+        target_calories=user['target_calories'] or 2000.0,
+        target_carbs=user['target_carbs'] or 250.0,
+        target_protein=user['target_protein'] or 100.0,
+        target_fat=user['target_fat'] or 70.0,
+        bmr=user['bmr'] or 1500.0,
+        tdee=user['tdee'] or 2000.0,
+        last_active=user['last_active'],
+        last_reminder_sent=user['last_reminder_sent'],
+        last_profile_update=user['last_profile_update'],
+        visceral_fat_level=visceral_fat_level if visceral_fat_level is not None else 0,
+        muscle_mass=muscle_mass if muscle_mass is not None else 0
+    )
+
+# 以 (user_id, updated_at, 資料版本) 為鍵快取 UserProfile；
+# updated_at 只精確到秒，同一秒內的連續更新靠 profile_version 區分
+_USER_PROFILE_CACHE = LockedTTLCache(maxsize=1024, ttl=3600)
+
 def get_user_data(user):
-    """安全地從用戶資料中提取所需資訊"""
+    """安全地從用戶資料中提取所需資訊
+
+    同一筆資料列（用戶未更新資料前）直接取用快取的 UserProfile，
+    不必每次事件都重新組一次；UserProfile 為不可變物件，可安全共用。
+    """
     if not user:
         return None
     
-    return {
-        'user_id': user[0],
-        'name': user[1] if len(user) > 1 else "用戶",
-        'age': user[2] if len(user) > 2 else 30,
-        'gender': user[3] if len(user) > 3 else "未設定",
-        'height': user[4] if len(user) > 4 else 170,
-        'weight': user[5] if len(user) > 5 else 70,
-        'activity_level': user[6] if len(user) > 6 else "中等活動量",
-        'health_goals': user[7] if len(user) > 7 else "維持健康",
-        'dietary_restrictions': user[8] if len(user) > 8 else "無",
-        'created_at': user[9] if len(user) > 9 else None,
-        'updated_at': user[10] if len(user) > 10 else None,
-        'body_fat_percentage': user[11] if len(user) > 11 else 20.0,
-        'diabetes_type': user[12] if len(user) > 12 else None,
-        'target_calories': user[13] if len(user) > 13 else 2000.0,
-        'target_carbs': user[14] if len(user) > 14 else 250.0,
-        'target_protein': user[15] if len(user) > 15 else 100.0,
-        'target_fat': user[16] if len(user) > 16 else 70.0,
-        'bmr': user[17] if len(user) > 17 else 1500.0,
-        'tdee': user[18] if len(user) > 18 else 2000.0,
-        'last_active': user[19] if len(user) > 19 else None,
-        'last_reminder_sent': user[20] if len(user) > 20 else None,
-        'last_profile_update': user[21] if len(user) > 21 else None,
-        'visceral_fat_level': user[22] if len(user) > 22 else 0,
-        'muscle_mass': user[23] if len(user) > 23 else 0
-    }
+    user_id = user['user_id']
+    key = (user_id, user['updated_at'], profile_version(user_id))
+    profile = _USER_PROFILE_CACHE.get(key)
+    if profile is None:
+        profile = _build_user_profile(user)
+        _USER_PROFILE_CACHE[key] = profile
+    return profile
+
+
+# 各功能 Prompt 使用的用戶背景描述
+NO_PROFILE_CONTEXT = "用戶未設定個人資料，請提供一般性建議。"
+
+CONSULT_PROFILE_TEMPLATE = """
+用戶資料：{name}，{age}歲，{gender}
+身高：{height}cm，體重：{weight}kg，體脂率：{body_fat_percentage:.1f}%
+活動量：{activity_level}
+健康目標：{health_goals}
+飲食限制：{dietary_restrictions}
+{diabetes_context}
+"""
+
+SUGGESTION_PROFILE_TEMPLATE = CONSULT_PROFILE_TEMPLATE + """
+每日營養目標：
+熱量：{target_calories:.0f}大卡，碳水：{target_carbs:.0f}g，蛋白質：{target_protein:.0f}g，脂肪：{target_fat:.0f}g
+"""
+
+ANALYSIS_PROFILE_TEMPLATE = """
+用戶資料：
+- 姓名：{name}，{age}歲，{gender}
+- 身高：{height}cm，體重：{weight}kg，體脂率：{body_fat_percentage:.1f}%
+- 活動量：{activity_level}
+- 健康目標：{health_goals}
+- 飲食限制：{dietary_restrictions}
+- 糖尿病類型：{diabetes_label}
+
+每日營養目標：
+熱量：{target_calories:.0f}大卡，碳水：{target_carbs:.0f}g，蛋白質：{target_protein:.0f}g，脂肪：{target_fat:.0f}g
+"""
 
+PROFILE_CONTEXT_TEMPLATES = {
+    'consult': CONSULT_PROFILE_TEMPLATE,
+    'suggest': SUGGESTION_PROFILE_TEMPLATE,
+    'analysis': ANALYSIS_PROFILE_TEMPLATE,
+}
+
+# 用戶資料版本：save_user 時遞增，讓快取的背景描述自動失效
+# 每位在本行程中更新過資料的用戶只佔一個整數；不做淘汰，淘汰後版本歸零會讓舊的快取內容重新生效
+_PROFILE_VERSIONS = {}
+_PROFILE_VERSIONS_LOCK = threading.Lock()
+
+def profile_version(user_id):
+    with _PROFILE_VERSIONS_LOCK:
+        return _PROFILE_VERSIONS.get(user_id, 0)
+
+def bump_profile_version(user_id):
+    with _PROFILE_VERSIONS_LOCK:
+        _PROFILE_VERSIONS[user_id] = _PROFILE_VERSIONS.get(user_id, 0) + 1
+
+@lru_cache(maxsize=4096)
+def _build_profile_context(user_id, version, kind):
+    user_data = get_user_data(UserManager.get_user(user_id))
+    if not user_data:
+        # 拋出例外而不回傳預設內容：lru_cache 不快取例外，資料庫暫時出錯時下次仍會重新讀取
+        raise LookupError(user_id)
+    diabetes = user_data.diabetes_type
+    return PROFILE_CONTEXT_TEMPLATES[kind].format_map(dict(
+        asdict(user_data),
+        diabetes_context=f"糖尿病類型：{diabetes}" if diabetes else "無糖尿病",
+        diabetes_label=diabetes if diabetes else '無'
+    ))
+
+def get_profile_context(user_id, kind):
+    """取得用戶背景描述（依資料版本快取，不必每則訊息重新組字串）"""
+    try:
+        return _build_profile_context(user_id, profile_version(user_id), kind)
+    except LookupError:
+        return NO_PROFILE_CONTEXT
+
+
+# 日期字串快取：today_str 到午夜才重新計算，days_ago_str 每 30 秒更新一次
+_TODAY_CACHE = {'date': '', 'expires': 0.0}
+_DAYS_AGO_CACHE = {}
+DAYS_AGO_CACHE_SECONDS = 30
+
+def today_str():
+    """取得今天的日期字串（YYYY-MM-DD）"""
+    now = time.time()
+    if now >= _TODAY_CACHE['expires']:
+        today = datetime.now()
+        next_midnight = datetime.combine(today.date() + timedelta(days=1), datetime.min.time())
+        _TODAY_CACHE['date'] = today.strftime('%Y-%m-%d')
+        _TODAY_CACHE['expires'] = next_midnight.timestamp()
+    return _TODAY_CACHE['date']
+
+def days_ago_str(days):
+    """取得 N 天前此刻的時間字串（YYYY-MM-DD HH:MM:SS），供查詢區間使用"""
+    now = time.time()
+    cached = _DAYS_AGO_CACHE.get(days)
+    if cached is None or now - cached[0] > DAYS_AGO_CACHE_SECONDS:
+        cached = (now, (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S'))
+        _DAYS_AGO_CACHE[days] = cached
+    return cached[1]
+
+# 食物偏好關鍵字
+FOOD_KEYWORDS = (
+    '飯', '麵', '雞肉', '豬肉', '牛肉', '魚', '蝦', '蛋', '豆腐', 
+    '青菜', '高麗菜', '菠菜', '蘿蔔', '番茄', '馬鈴薯', '地瓜',
+    '便當', '沙拉', '湯', '粥', '麵包', '水果', '優格', '堅果',
+    '糙米', '燕麥', '雞胸肉', '鮭魚', '酪梨', '花椰菜'
+)
 
+# 依關鍵字首字建立索引，掃描描述一次即可找出所有關鍵字（包含重疊的，例如「麵」與「麵包」）
+FOOD_KEYWORD_INDEX = {}
+for _keyword in FOOD_KEYWORDS:
+    FOOD_KEYWORD_INDEX.setdefault(_keyword[0], []).append(_keyword)
+
+def match_food_keywords(description):
+    """找出描述中出現的所有食物關鍵字"""
+    matched = set()
+    for i, char in enumerate(description):
+        candidates = FOOD_KEYWORD_INDEX.get(char)
+        if candidates:
+            for keyword in candidates:
+                if description.startswith(keyword, i):
+                    matched.add(keyword)
+    return matched
+
+# 食物偏好累計：一次 executemany 完成新增或遞增頻率
+FOOD_PREFERENCE_UPSERT_SQL = '''
+    INSERT INTO food_preferences (user_id, food_item, frequency, last_eaten)
+    VALUES (?, ?, 1, CURRENT_TIMESTAMP)
+    ON CONFLICT(user_id, food_item) DO UPDATE SET
+        frequency = frequency + 1,
+        last_eaten = CURRENT_TIMESTAMP
+'''
+
+
+# 每日營養總結累計：不存在時新增，存在時累加（daily_nutrition 有 UNIQUE(user_id, date)）
+DAILY_NUTRITION_UPSERT_SQL = '''
+    INSERT INTO daily_nutrition
+    (user_id, date, total_calories, total_carbs, total_protein, total_fat,
+    total_fiber, total_sugar, meal_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, (
+        SELECT COUNT(*) FROM meal_records
+        WHERE user_id = ? AND DATE(recorded_at) = ?
+    ))
+    ON CONFLICT(user_id, date) DO UPDATE SET
+        total_calories = total_calories + excluded.total_calories,
+        total_carbs = total_carbs + excluded.total_carbs,
+        total_protein = total_protein + excluded.total_protein,
+        total_fat = total_fat + excluded.total_fat,
+        total_fiber = total_fiber + excluded.total_fiber,
+        total_sugar = total_sugar + excluded.total_sugar,
+        meal_count = excluded.meal_count
+'''
+
+# UserManager 使用的 SQL 語句（固定字串，可重複利用 sqlite3 的語句快取）
+GET_USER_SQL = 'SELECT * FROM users WHERE user_id = ?'
+
+GET_DAILY_NUTRITION_SQL = 'SELECT * FROM daily_nutrition WHERE user_id = ? AND date = ?'
+
+# UPSERT：已存在的用戶只更新這些欄位，保留 created_at 等其他欄位
+SAVE_USER_SQL = '''
+    INSERT INTO users 
+    (user_id, name, age, gender, height, weight, activity_level, health_goals, 
+    dietary_restrictions, body_fat_percentage, diabetes_type, target_calories, 
+    target_carbs, target_protein, target_fat, bmr, tdee, last_active, 
+    last_profile_update, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 
+        CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+    ON CONFLICT(user_id) DO UPDATE SET
+        name = excluded.name,
+        age = excluded.age,
+        gender = excluded.gender,
+        height = excluded.height,
+        weight = excluded.weight,
+        activity_level = excluded.activity_level,
+        health_goals = excluded.health_goals,
+        dietary_restrictions = excluded.dietary_restrictions,
+        body_fat_percentage = excluded.body_fat_percentage,
+        diabetes_type = excluded.diabetes_type,
+        target_calories = excluded.target_calories,
+        target_carbs = excluded.target_carbs,
+        target_protein = excluded.target_protein,
+        target_fat = excluded.target_fat,
+        bmr = excluded.bmr,
+        tdee = excluded.tdee,
+        last_active = CURRENT_TIMESTAMP,
+        last_profile_update = CURRENT_TIMESTAMP,
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+INSERT_MEAL_WITH_NUTRITION_SQL = '''
+    INSERT INTO meal_records 
+    (user_id, meal_type, meal_description, nutrition_analysis,
+    calories, carbs, protein, fat, fiber, sugar)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# 營養素欄位使用預設值 0
+INSERT_MEAL_SQL = '''
+    INSERT INTO meal_records 
+    (user_id, meal_type, meal_description, nutrition_analysis)
+    VALUES (?, ?, ?, ?)
+'''
+
+GET_WEEKLY_MEALS_SQL = '''
+    SELECT meal_type, meal_description, nutrition_analysis, recorded_at
+    FROM meal_records 
+    WHERE user_id = ? AND recorded_at >= ?
+    ORDER BY recorded_at DESC
+'''
+
+GET_FOOD_PREFERENCES_SQL = '''
+    SELECT food_item, frequency, last_eaten
+    FROM food_preferences 
+    WHERE user_id = ?
+    ORDER BY frequency DESC, last_eaten DESC
+    LIMIT ?
+'''
+
+GET_RECENT_MEALS_SQL = '''
+    SELECT meal_description, recorded_at
+    FROM meal_records 
+    WHERE user_id = ? AND recorded_at >= ?
+    ORDER BY recorded_at DESC
+    LIMIT 10
+'''
+
+# 飲食建議需要的資料：用戶資料、最近飲食、常吃食物
+SuggestionBundle = namedtuple('SuggestionBundle', ['user', 'recent_meals', 'preferences'])
+
+# 飲食建議資料快取（60 秒），寫入飲食記錄或更新個人資料時清除
+_SUGGESTION_BUNDLE_CACHE = LockedTTLCache(maxsize=4096, ttl=60)
+
+# 每日營養總結快取（30 秒，key 為 (user_id, 日期)），寫入飲食記錄時清除當天的快取
+_DAILY_NUTRITION_CACHE = LockedTTLCache(maxsize=4096, ttl=30)
+_CACHE_MISS = object()
+
+# 活動係數
+ACTIVITY_MULTIPLIER = {'低活動量': 1.2, '中等活動量': 1.55, '高活動量': 1.9}
+
+@lru_cache(maxsize=2048)
+def compute_targets(gender, weight, height, age, activity_level):
+    """計算 BMR、TDEE 與每日營養目標，回傳 (bmr, tdee, 熱量, 碳水, 蛋白質, 脂肪)"""
+    # 簡單的熱量計算（可以後續改進）
+    if gender == '男性':
+        bmr = 88.362 + (13.397 * weight) + (4.799 * height) - (5.677 * age)
+    else:
+        bmr = 447.593 + (9.247 * weight) + (3.098 * height) - (4.330 * age)
+    
+    tdee = bmr * ACTIVITY_MULTIPLIER.get(activity_level, 1.2)
+    
+    # 營養素分配 (碳水50%, 蛋白質20%, 脂肪30%)
+    target_calories = tdee
+    target_carbs = (tdee * 0.5) / 4  # 碳水1g = 4卡
+    target_protein = (tdee * 0.2) / 4  # 蛋白質1g = 4卡
+    target_fat = (tdee * 0.3) / 9  # 脂肪1g = 9卡
+    
+    return bmr, tdee, target_calories, target_carbs, target_protein, target_fat
 
 class UserManager:
     @staticmethod
     def get_user(user_id):
-        conn = None
+        with _USER_CACHE_LOCK:
+            if user_id in _USER_CACHE:
+                _USER_CACHE.move_to_end(user_id)
+                return _USER_CACHE[user_id]
+        
         try:
-            conn = sqlite3.connect('nutrition_bot.db', timeout=10.0)
-            cursor = conn.cursor()
-            cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-            user = cursor.fetchone()
+            with DB_POOL.get_conn() as conn:
+                user = conn.execute(GET_USER_SQL, (user_id,)).fetchone()
+            
+            # 尚未建立資料的用戶不快取，避免設定完成後仍讀到 None
+            if user is not None:
+                with _USER_CACHE_LOCK:
+                    _USER_CACHE[user_id] = user
+                    _USER_CACHE.move_to_end(user_id)
+                    if len(_USER_CACHE) > USER_CACHE_MAXSIZE:
+                        _USER_CACHE.popitem(last=False)
             return user
         except Exception as e:
             print(f"取得用戶資料錯誤：{e}")
             return None
-        finally:
-            if conn:
-                conn.close()
     
     @staticmethod
     def get_daily_nutrition(user_id, date=None):
         """取得每日營養總結"""
         if date is None:
-            date = datetime.now().strftime('%Y-%m-%d')
+            date = today_str()
+        
+        # 當天還沒有記錄（None）也一併快取，查詢失敗則不快取
+        cached = _DAILY_NUTRITION_CACHE.get((user_id, date), _CACHE_MISS)
+        if cached is not _CACHE_MISS:
+            return cached
         
-        conn = None
         try:
-            conn = sqlite3.connect('nutrition_bot.db', timeout=10.0)
-            cursor = conn.cursor()
-            
             print(f"🔍 DEBUG - 查詢每日營養：user_id={user_id}, date={date}")
-            
-            cursor.execute('''
-                SELECT * FROM daily_nutrition WHERE user_id = ? AND date = ?
-            ''', (user_id, date))
-            result = cursor.fetchone()
-            
-            print(f"🔍 DEBUG - 查詢結果：{result}")
-            
+
+            with DB_POOL.get_conn() as conn:
+                result = conn.execute(GET_DAILY_NUTRITION_SQL, (user_id, date)).fetchone()
+
+            print(f"🔍 DEBUG - 查詢結果：{tuple(result) if result else None}")
+
+            _DAILY_NUTRITION_CACHE[(user_id, date)] = result
             return result
         except Exception as e:
             print(f"❌ 取得每日營養總結錯誤：{e}")
             return None
-        finally:
-            if conn:
-                conn.close()
 
 
     @staticmethod
     def save_user(user_id, user_data):
-        conn = sqlite3.connect('nutrition_bot.db')
-        cursor = conn.cursor()
-        
-        # 計算基本 BMI 和預設營養目標
-        height_m = user_data['height'] / 100
-        bmi = user_data['weight'] / (height_m ** 2)
-        
-        # 簡單的熱量計算（可以後續改進）
-        if user_data['gender'] == '男性':
-            bmr = 88.362 + (13.397 * user_data['weight']) + (4.799 * user_data['height']) - (5.677 * user_data['age'])
-        else:
-            bmr = 447.593 + (9.247 * user_data['weight']) + (3.098 * user_data['height']) - (4.330 * user_data['age'])
-        
-        # 活動係數
-        activity_multiplier = {'低活動量': 1.2, '中等活動量': 1.55, '高活動量': 1.9}
-        tdee = bmr * activity_multiplier.get(user_data['activity_level'], 1.2)
+        # 計算預設營養目標
+        bmr, tdee, target_calories, target_carbs, target_protein, target_fat = compute_targets(
+            user_data['gender'], user_data['weight'], user_data['height'],
+            user_data['age'], user_data['activity_level']
+        )
         
-        # 營養素分配 (碳水50%, 蛋白質20%, 脂肪30%)
-        target_calories = tdee
-        target_carbs = (tdee * 0.5) / 4  # 碳水1g = 4卡
-        target_protein = (tdee * 0.2) / 4  # 蛋白質1g = 4卡
-        target_fat = (tdee * 0.3) / 9  # 脂肪1g = 9卡
+        with DB_POOL.get_conn() as conn:
+            conn.execute(SAVE_USER_SQL, (
+                user_id, user_data['name'], user_data['age'], user_data['gender'],
+                user_data['height'], user_data['weight'], user_data['activity_level'],
+                user_data['health_goals'], user_data['dietary_restrictions'],
+                user_data.get('body_fat_percentage', 0), user_data.get('diabetes_type'),
+                target_calories, target_carbs, target_protein, target_fat, bmr, tdee
+            ))
         
-        cursor.execute('''
-            INSERT OR REPLACE INTO users 
-            (user_id, name, age, gender, height, weight, activity_level, health_goals, 
-            dietary_restrictions, body_fat_percentage, diabetes_type, target_calories, 
-            target_carbs, target_protein, target_fat, bmr, tdee, last_active, 
-            last_profile_update, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 
-                CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
-        ''', (
-            user_id, user_data['name'], user_data['age'], user_data['gender'],
-            user_data['height'], user_data['weight'], user_data['activity_level'],
-            user_data['health_goals'], user_data['dietary_restrictions'],
-            user_data.get('body_fat_percentage', 0), user_data.get('diabetes_type'),
-            target_calories, target_carbs, target_protein, target_fat, bmr, tdee
-        ))
-        conn.commit()
-        conn.close()
+        # 寫入後使該用戶的快取失效
+        with _USER_CACHE_LOCK:
+            _USER_CACHE.pop(user_id, None)
+        _SUGGESTION_BUNDLE_CACHE.pop(user_id, None)
+        bump_profile_version(user_id)
     
     @staticmethod  
     def save_meal_record(user_id, meal_type, meal_description, analysis, nutrition_data=None):
-        conn = None
         try:
-            conn = sqlite3.connect('nutrition_bot.db', timeout=20.0)
-            cursor = conn.cursor()
-            
-            print(f"🔍 DEBUG - 開始儲存記錄：{meal_type} - {meal_description}")
-            print(f"🔍 DEBUG - 營養數據：{nutrition_data}")
-            
-            # 🔧 修正：確保營養素欄位存在
-            cursor.execute("PRAGMA table_info(meal_records)")
-            columns = [column[1] for column in cursor.fetchall()]
-            print(f"🔍 DEBUG - meal_records 表欄位：{columns}")
-            
-            has_nutrition_columns = all(col in columns for col in ['calories', 'carbs', 'protein', 'fat', 'fiber', 'sugar'])
-            print(f"🔍 DEBUG - 是否有營養素欄位：{has_nutrition_columns}")
-            
-            if not has_nutrition_columns:
-                # 如果沒有營養素欄位，先添加
-                nutrition_columns = [
-                    ('calories', 'REAL DEFAULT 0'),
-                    ('carbs', 'REAL DEFAULT 0'),
-                    ('protein', 'REAL DEFAULT 0'),
-                    ('fat', 'REAL DEFAULT 0'),
-                    ('fiber', 'REAL DEFAULT 0'),
-                    ('sugar', 'REAL DEFAULT 0')
-                ]
-                
-                for column_name, column_type in nutrition_columns:
-                    try:
-                        cursor.execute(f'ALTER TABLE meal_records ADD COLUMN {column_name} {column_type}')
-                        print(f"✅ 已添加營養素欄位：{column_name}")
-                    except sqlite3.OperationalError as e:
-                        if "duplicate column name" not in str(e):
-                            print(f"❌ 添加欄位 {column_name} 失敗：{e}")
-            
-            # 🔧 修正：總是儲存營養數據
-            if nutrition_data:
-                cursor.execute('''
-                    INSERT INTO meal_records 
-                    (user_id, meal_type, meal_description, nutrition_analysis,
-                    calories, carbs, protein, fat, fiber, sugar)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    user_id, meal_type, meal_description, analysis,
-                    nutrition_data.get('calories', 0), nutrition_data.get('carbs', 0),
-                    nutrition_data.get('protein', 0), nutrition_data.get('fat', 0),
-                    nutrition_data.get('fiber', 0), nutrition_data.get('sugar', 0)
-                ))
-                print(f"✅ 已儲存完整營養數據到 meal_records")
-            else:
-                # 如果沒有營養數據，使用預設值
-                cursor.execute('''
-                    INSERT INTO meal_records 
-                    (user_id, meal_type, meal_description, nutrition_analysis,
-                    calories, carbs, protein, fat, fiber, sugar)
-                    VALUES (?, ?, ?, ?, 0, 0, 0, 0, 0, 0)
-                ''', (user_id, meal_type, meal_description, analysis))
-                print(f"⚠️ 儲存記錄但無營養數據")
+            with DB_POOL.get_conn() as conn:
+                # 餐點記錄、每日營養總結、食物偏好在同一個交易內寫入，只需一次提交
+                conn.execute('BEGIN IMMEDIATE')
+            
+                print(f"🔍 DEBUG - 開始儲存記錄：{meal_type} - {meal_description}")
+                print(f"🔍 DEBUG - 營養數據：{nutrition_data}")
+            
+                # 🔧 修正：總是儲存營養數據（欄位結構已於啟動時確認）
+                if MEAL_RECORDS_HAS_NUTRITION_COLS and nutrition_data:
+                    conn.execute(INSERT_MEAL_WITH_NUTRITION_SQL, (
+                        user_id, meal_type, meal_description, analysis,
+                        nutrition_data.get('calories', 0), nutrition_data.get('carbs', 0),
+                        nutrition_data.get('protein', 0), nutrition_data.get('fat', 0),
+                        nutrition_data.get('fiber', 0), nutrition_data.get('sugar', 0)
+                    ))
+                    print(f"✅ 已儲存完整營養數據到 meal_records")
+                else:
+                    # 如果沒有營養數據，營養素欄位使用預設值 0
+                    conn.execute(INSERT_MEAL_SQL, (user_id, meal_type, meal_description, analysis))
+                    print(f"⚠️ 儲存記錄但無營養數據")
             
-            conn.commit()
-            print(f"✅ meal_records 儲存成功")
+                print(f"✅ meal_records 儲存成功")
             
-            # 🔧 修正：確保更新每日營養總結
-            if nutrition_data:
-                UserManager._update_daily_nutrition_with_conn(conn, user_id, nutrition_data)
-                print(f"✅ 每日營養總結更新完成")
+                # 🔧 修正：確保更新每日營養總結
+                if nutrition_data:
+                    UserManager._update_daily_nutrition_with_conn(conn, user_id, nutrition_data)
+                    print(f"✅ 每日營養總結更新完成")
             
-            # 更新食物偏好
-            UserManager._update_food_preferences_with_conn(conn, user_id, meal_description)
+                # 更新食物偏好
+                UserManager._update_food_preferences_with_conn(conn, user_id, meal_description)
             
-            conn.commit()
-            print(f"✅ 所有資料儲存完成")
+                conn.execute('COMMIT')
+                print(f"✅ 所有資料儲存完成")
             
+            _SUGGESTION_BUNDLE_CACHE.pop(user_id, None)
+            _DAILY_NUTRITION_CACHE.pop((user_id, today_str()), None)
+
         except Exception as e:
-            if conn:
-                conn.rollback()
+            # 未提交的交易已在歸還連線池時回滾
             print(f"❌ 儲存記錄失敗：{e}")
             raise e
-        finally:
-            if conn:
-                conn.close()
     
     @staticmethod
     def _update_daily_nutrition_with_conn(conn, user_id, nutrition_data):
         """使用現有連線更新每日營養總結"""
         try:
-            today = datetime.now().strftime('%Y-%m-%d')
-            cursor = conn.cursor()
+            today = today_str()
             
             print(f"🔍 DEBUG - 更新每日營養：{today}")
             print(f"🔍 DEBUG - 營養數據：{nutrition_data}")
             
-            # 🔧 修正：確保 daily_nutrition 表存在且有正確欄位
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS daily_nutrition (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT,
-                    date TEXT,
-                    total_calories REAL DEFAULT 0,
-                    total_carbs REAL DEFAULT 0,
-                    total_protein REAL DEFAULT 0,
-                    total_fat REAL DEFAULT 0,
-                    total_fiber REAL DEFAULT 0,
-                    total_sugar REAL DEFAULT 0,
-                    meal_count INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(user_id, date),
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
-            ''')
-            
-            # 🔧 重要修正：計算今日實際餐數
-            cursor.execute('''
-                SELECT COUNT(*) FROM meal_records 
-                WHERE user_id = ? AND DATE(recorded_at) = ?
-            ''', (user_id, today))
-            actual_meal_count = cursor.fetchone()[0]
-            
-            print(f"🔍 DEBUG - 查詢到的實際餐數：{actual_meal_count}")
-            
-            # 檢查今日記錄是否存在
-            cursor.execute('''
-                SELECT total_calories, total_carbs, total_protein, total_fat, meal_count 
-                FROM daily_nutrition WHERE user_id = ? AND date = ?
-            ''', (user_id, today))
-            existing_record = cursor.fetchone()
-
-            if existing_record:
-                # 🔧 修正：更新現有記錄，但餐數基於實際計算
-                cursor.execute('''
-                    UPDATE daily_nutrition SET
-                        total_calories = total_calories + ?,
-                        total_carbs = total_carbs + ?,
-                        total_protein = total_protein + ?,
-                        total_fat = total_fat + ?,
-                        total_fiber = total_fiber + ?,
-                        total_sugar = total_sugar + ?,
-                        meal_count = ?
-                    WHERE user_id = ? AND date = ?
-                ''', (
-                    nutrition_data.get('calories', 0), nutrition_data.get('carbs', 0),
-                    nutrition_data.get('protein', 0), nutrition_data.get('fat', 0),
-                    nutrition_data.get('fiber', 0), nutrition_data.get('sugar', 0),
-                    actual_meal_count,  # 🔧 使用實際計算的餐數
-                    user_id, today
-                ))
-                print(f"✅ 更新現有每日營養記錄，餐數設為：{actual_meal_count}")
-            else:
-                # 🔧 修正：插入新記錄，餐數設為實際計算值
-                cursor.execute('''
-                    INSERT INTO daily_nutrition 
-                    (user_id, date, total_calories, total_carbs, total_protein, total_fat, 
-                    total_fiber, total_sugar, meal_count)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (
-                    user_id, today,
-                    nutrition_data.get('calories', 0), nutrition_data.get('carbs', 0),
-                    nutrition_data.get('protein', 0), nutrition_data.get('fat', 0),
-                    nutrition_data.get('fiber', 0), nutrition_data.get('sugar', 0),
-                    actual_meal_count  # 🔧 使用實際計算的餐數
-                ))
-                print(f"✅ 插入新的每日營養記錄，餐數設為：{actual_meal_count}")
-            
-            # 驗證儲存結果
-            cursor.execute('''
-                SELECT total_calories, total_carbs, total_protein, total_fat, meal_count 
-                FROM daily_nutrition WHERE user_id = ? AND date = ?
-            ''', (user_id, today))
-            verification = cursor.fetchone()
-            print(f"🔍 DEBUG - 儲存後驗證：{verification}")
+            # 單一 UPSERT：新增或累加今日營養，餐數以實際記錄數計算
+            conn.execute(DAILY_NUTRITION_UPSERT_SQL, (
+                user_id, today,
+                nutrition_data.get('calories', 0), nutrition_data.get('carbs', 0),
+                nutrition_data.get('protein', 0), nutrition_data.get('fat', 0),
+                nutrition_data.get('fiber', 0), nutrition_data.get('sugar', 0),
+                user_id, today
+            ))
+            print(f"✅ 每日營養記錄已更新")
             
         except Exception as e:
             print(f"❌ 更新每日營養總結失敗：{e}")
@@ -481,207 +1102,83 @@ class UserManager:
     def _update_food_preferences_with_conn(conn, user_id, meal_description):
         """使用現有連線更新食物偏好記錄"""
         try:
-            cursor = conn.cursor()
-            
-            # 擴展食物關鍵字
-            food_keywords = [
-                '飯', '麵', '雞肉', '豬肉', '牛肉', '魚', '蝦', '蛋', '豆腐', 
-                '青菜', '高麗菜', '菠菜', '蘿蔔', '番茄', '馬鈴薯', '地瓜',
-                '便當', '沙拉', '湯', '粥', '麵包', '水果', '優格', '堅果',
-                '糙米', '燕麥', '雞胸肉', '鮭魚', '酪梨', '花椰菜'
-            ]
-            
-            for keyword in food_keywords:
-                if keyword in meal_description:
-                    cursor.execute('''
-                        SELECT frequency FROM food_preferences 
-                        WHERE user_id = ? AND food_item = ?
-                    ''', (user_id, keyword))
-                    result = cursor.fetchone()
-                    
-                    if result:
-                        cursor.execute('''
-                            UPDATE food_preferences 
-                            SET frequency = frequency + 1, last_eaten = CURRENT_TIMESTAMP
-                            WHERE user_id = ? AND food_item = ?
-                        ''', (user_id, keyword))
-                    else:
-                        cursor.execute('''
-                            INSERT INTO food_preferences (user_id, food_item)
-                            VALUES (?, ?)
-                        ''', (user_id, keyword))
+            conn.executemany(FOOD_PREFERENCE_UPSERT_SQL, [
+                (user_id, keyword) for keyword in match_food_keywords(meal_description)
+            ])
             
         except Exception as e:
             print(f"更新食物偏好失敗：{e}")
 
 
-    @staticmethod
-    def update_food_preferences(user_id, meal_description):
-        """更新用戶食物偏好記錄"""
-        conn = sqlite3.connect('nutrition_bot.db')
-        cursor = conn.cursor()
-        
-        # 簡單的食物項目提取（可以改進為更複雜的 NLP）
-        food_keywords = ['飯', '麵', '雞肉', '豬肉', '牛肉', '魚', '蝦', '蛋', '豆腐', 
-                        '青菜', '高麗菜', '菠菜', '蘿蔔', '番茄', '馬鈴薯', '地瓜',
-                        '便當', '沙拉', '湯', '粥', '麵包', '水果', '優格', '堅果']
-        
-        for keyword in food_keywords:
-            if keyword in meal_description:
-                # 檢查是否已存在
-                cursor.execute('''
-                    SELECT frequency FROM food_preferences 
-                    WHERE user_id = ? AND food_item = ?
-                ''', (user_id, keyword))
-                result = cursor.fetchone()
-                
-                if result:
-                    # 更新頻率
-                    cursor.execute('''
-                        UPDATE food_preferences 
-                        SET frequency = frequency + 1, last_eaten = CURRENT_TIMESTAMP
-                        WHERE user_id = ? AND food_item = ?
-                    ''', (user_id, keyword))
-                else:
-                    # 新增記錄
-                    cursor.execute('''
-                        INSERT INTO food_preferences (user_id, food_item)
-                        VALUES (?, ?)
-                    ''', (user_id, keyword))
-        
-        conn.commit()
-        conn.close()
-    
-    @staticmethod
-    def update_daily_nutrition(user_id, nutrition_data):
-        """更新每日營養總結"""
-        try:
-            today = datetime.now().strftime('%Y-%m-%d')
-            conn = sqlite3.connect('nutrition_bot.db')
-            cursor = conn.cursor()
-            
-            # 檢查 daily_nutrition 表是否存在
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS daily_nutrition (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT,
-                    date TEXT,
-                    total_calories REAL DEFAULT 0,
-                    total_carbs REAL DEFAULT 0,
-                    total_protein REAL DEFAULT 0,
-                    total_fat REAL DEFAULT 0,
-                    total_fiber REAL DEFAULT 0,
-                    total_sugar REAL DEFAULT 0,
-                    meal_count INTEGER DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(user_id, date),
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
-            ''')
-            
-            cursor.execute('''
-                INSERT OR IGNORE INTO daily_nutrition (user_id, date) VALUES (?, ?)
-            ''', (user_id, today))
-            
-            cursor.execute('''
-                UPDATE daily_nutrition SET
-                    total_calories = total_calories + ?,
-                    total_carbs = total_carbs + ?,
-                    total_protein = total_protein + ?,
-                    total_fat = total_fat + ?,
-                    total_fiber = total_fiber + ?,
-                    total_sugar = total_sugar + ?,
-                    meal_count = meal_count + 1
-                WHERE user_id = ? AND date = ?
-            ''', (
-                nutrition_data.get('calories', 0), nutrition_data.get('carbs', 0),
-                nutrition_data.get('protein', 0), nutrition_data.get('fat', 0),
-                nutrition_data.get('fiber', 0), nutrition_data.get('sugar', 0),
-                user_id, today
-            ))
-            
-            conn.commit()
-            conn.close()
-            
-        except Exception as e:
-            print(f"更新每日營養總結失敗：{e}")
-
     @staticmethod
     def get_weekly_meals(user_id):
-        conn = None
         try:
-            conn = sqlite3.connect('nutrition_bot.db', timeout=10.0)
-            cursor = conn.cursor()
-            week_ago = (datetime.now() - timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S')
-            cursor.execute('''
-                SELECT meal_type, meal_description, nutrition_analysis, recorded_at
-                FROM meal_records 
-                WHERE user_id = ? AND recorded_at >= ?
-                ORDER BY recorded_at DESC
-            ''', (user_id, week_ago))
-            records = cursor.fetchall()
+            week_ago = days_ago_str(7)
+            with DB_POOL.get_conn() as conn:
+                records = conn.execute(GET_WEEKLY_MEALS_SQL, (user_id, week_ago)).fetchall()
             return records
         except Exception as e:
             print(f"取得週記錄錯誤：{e}")
             return []
-        finally:
-            if conn:
-                conn.close()
     
     @staticmethod
     def get_food_preferences(user_id, limit=10):
         """取得用戶最常吃的食物"""
-        conn = sqlite3.connect('nutrition_bot.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT food_item, frequency, last_eaten
-            FROM food_preferences 
-            WHERE user_id = ?
-            ORDER BY frequency DESC, last_eaten DESC
-            LIMIT ?
-        ''', (user_id, limit))
-        preferences = cursor.fetchall()
-        conn.close()
+        with DB_POOL.get_conn() as conn:
+            preferences = conn.execute(GET_FOOD_PREFERENCES_SQL, (user_id, limit)).fetchall()
         return preferences
     
     @staticmethod
     def get_recent_meals(user_id, days=3):
         """取得最近幾天的餐點"""
-        conn = sqlite3.connect('nutrition_bot.db')
-        cursor = conn.cursor()
-        days_ago = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
-        cursor.execute('''
-            SELECT meal_description, recorded_at
-            FROM meal_records 
-            WHERE user_id = ? AND recorded_at >= ?
-            ORDER BY recorded_at DESC
-            LIMIT 10
-        ''', (user_id, days_ago))
-        meals = cursor.fetchall()
-        conn.close()
+        days_ago = days_ago_str(days)
+        with DB_POOL.get_conn() as conn:
+            meals = conn.execute(GET_RECENT_MEALS_SQL, (user_id, days_ago)).fetchall()
         return meals
+    
+    @staticmethod
+    def get_suggestion_bundle(user_id, days=3, limit=10):
+        """一次取得飲食建議需要的用戶資料、最近飲食與常吃食物（同一連線、同一個讀取交易）"""
+        bundle = _SUGGESTION_BUNDLE_CACHE.get(user_id)
+        if bundle is not None:
+            return bundle
+        
+        days_ago = days_ago_str(days)
+        with DB_POOL.get_conn() as conn:
+            conn.execute('BEGIN')
+            user = conn.execute(GET_USER_SQL, (user_id,)).fetchone()
+            if user is None:
+                conn.execute('COMMIT')
+                return SuggestionBundle(None, [], [])
+            recent_meals = conn.execute(GET_RECENT_MEALS_SQL, (user_id, days_ago)).fetchall()
+            preferences = conn.execute(GET_FOOD_PREFERENCES_SQL, (user_id, limit)).fetchall()
+            conn.execute('COMMIT')
+        
+        bundle = SuggestionBundle(user, recent_meals, preferences)
+        _SUGGESTION_BUNDLE_CACHE[user_id] = bundle
+        return bundle
+
+# 飲食建議請求
+SUGGESTION_KEYWORDS = ('推薦', '建議', '吃什麼', '不知道要吃什麼', '給我建議', 
+                       '推薦食物', '今天吃什麼', '早餐吃什麼', '午餐吃什麼', '晚餐吃什麼')
+
+# 食物諮詢
+CONSULTATION_KEYWORDS = ('可以吃', '能吃', '適合', '會不會', '這個好嗎', 
+                         '有什麼影響', '建議吃', '怎麼吃', '份量')
+
+# 預先編譯成單一正規表示式，每則訊息只需掃描一次（問號也視為諮詢）
+_SUGGEST_RE = re.compile('|'.join(map(re.escape, SUGGESTION_KEYWORDS)))
+_CONSULT_RE = re.compile('|'.join(map(re.escape, CONSULTATION_KEYWORDS + ('?', '？'))))
 
 class MessageAnalyzer:
     """分析用戶訊息意圖"""
     
     @staticmethod
     def detect_intent(message):
-        message_lower = message.lower()
-        
-        # 飲食建議請求
-        suggestion_keywords = ['推薦', '建議', '吃什麼', '不知道要吃什麼', '給我建議', 
-                             '推薦食物', '今天吃什麼', '早餐吃什麼', '午餐吃什麼', '晚餐吃什麼']
-        
-        # 食物諮詢
-        consultation_keywords = ['可以吃', '能吃', '適合', '會不會', '這個好嗎', 
-                               '有什麼影響', '建議吃', '怎麼吃', '份量']
-        
-        # 檢查意圖
-        if any(keyword in message_lower for keyword in suggestion_keywords):
+        # 關鍵字皆為中文與問號，不需轉小寫
+        if _SUGGEST_RE.search(message):
             return 'suggestion'
-        elif any(keyword in message_lower for keyword in consultation_keywords):
-            return 'consultation'
-        elif '?' in message or '？' in message:
+        elif _CONSULT_RE.search(message):
             return 'consultation'
         else:
             return 'record'  # 預設為記錄飲食
@@ -714,8 +1211,7 @@ def handle_text_message(event):
     
     if message_text.lower().strip() in ['重新啟動', '重啟', 'restart', 'reset', '重置', '重新開始', '清除', '初始化', '卡住了', '不動了', '重來']:
         # 清除用戶狀態
-        if user_id in user_states:
-            del user_states[user_id]
+        user_states.pop(user_id, None)
         
         # 重新初始化
         user_states[user_id] = {'step': 'normal'}
@@ -743,9 +1239,8 @@ def handle_text_message(event):
         )
         return
 
-    # 檢查用戶狀態
-    if user_id not in user_states:
-        user_states[user_id] = {'step': 'normal'}
+    # 檢查用戶狀態（重新寫入以延長有效時間，進行中的流程不會被清除）
+    user_states[user_id] = user_states.get(user_id) or {'step': 'normal'}
 
     # 🔧 新增：處理飲食記錄確認流程
     if user_states[user_id]['step'] == 'confirm_meal_record':
@@ -768,7 +1263,7 @@ def handle_text_message(event):
     elif message_text == "設定個人資料":
         start_profile_setup(event)
     elif message_text == "週報告":
-        generate_weekly_report(event)
+        run_in_background(generate_weekly_report, event)
     elif message_text == "我的資料":
         show_user_profile(event)
     elif message_text == "使用說明":
@@ -784,10 +1279,10 @@ def handle_text_message(event):
         if intent == 'suggestion':
             provide_meal_suggestions(event, message_text)
         elif intent == 'consultation':
-            provide_food_consultation(event, message_text)
+            run_in_background(provide_food_consultation, event, message_text)
         else:
             # 預設為記錄飲食
-            analyze_food_description_with_confirmation(event, message_text)
+            run_in_background(analyze_food_description_with_confirmation, event, message_text)
 
 def handle_welcome(event):
     user_id = event.source.user_id
@@ -795,7 +1290,7 @@ def handle_welcome(event):
     
     if user:
         user_data = get_user_data(user)
-        name = user_data['name'] if user_data['name'] else "朋友"
+        name = user_data.name if user_data.name else "朋友"
         welcome_text = f"""👋 歡迎回來，{name}！
 
 我是你的專屬AI營養師，可以：
@@ -890,7 +1385,7 @@ def handle_meal_record_confirmation(event, message_text):
             
             # 🔧 新增：立即驗證儲存結果
             daily_nutrition = UserManager.get_daily_nutrition(user_id)
-            print(f"🔍 DEBUG - 儲存後每日營養：{daily_nutrition}")
+            print(f"🔍 DEBUG - 儲存後每日營養：{tuple(daily_nutrition) if daily_nutrition else None}")
             
             # 發送成功確認訊息
             nutrition_data = confirm_data['nutrition_data']
@@ -969,7 +1464,7 @@ def clean_duplicate_nutrition_records():
     """清理 daily_nutrition 表中可能的重複記錄"""
     conn = None
     try:
-        conn = sqlite3.connect('nutrition_bot.db', timeout=20.0)
+        conn = get_db_connection(timeout=20.0)
         cursor = conn.cursor()
         
         print("🧹 開始清理 daily_nutrition 重複記錄...")
@@ -1031,7 +1526,7 @@ def fix_all_users_meal_count():
     """修正所有用戶今日的餐數計算"""
     conn = None
     try:
-        conn = sqlite3.connect('nutrition_bot.db', timeout=20.0)
+        conn = get_db_connection(timeout=20.0)
         cursor = conn.cursor()
         today = datetime.now().strftime('%Y-%m-%d')
         
@@ -1143,10 +1638,10 @@ def show_daily_progress(event):
         meal_count = actual_meal_count
         
         # 目標數據
-        target_calories = user_data['target_calories']
-        target_carbs = user_data['target_carbs']
-        target_protein = user_data['target_protein']
-        target_fat = user_data['target_fat']
+        target_calories = user_data.target_calories
+        target_carbs = user_data.target_carbs
+        target_protein = user_data.target_protein
+        target_fat = user_data.target_fat
         
         # 計算進度百分比
         calories_percent = (current_calories / target_calories * 100) if target_calories > 0 else 0
@@ -1178,7 +1673,7 @@ def show_daily_progress(event):
         # 組合今日進度報告
         progress_text = f"""📊 今日營養進度
 
-👤 {user_data['name']} 的營養追蹤
+👤 {user_data.name} 的營養追蹤
 
 🔥 熱量進度：
 {generate_progress_bar(calories_percent)}
@@ -1240,17 +1735,12 @@ def get_today_meals(user_id):
     """取得今日所有餐點記錄"""
     conn = None
     try:
-        conn = sqlite3.connect('nutrition_bot.db', timeout=10.0)
+        conn = get_db_connection(timeout=10.0)
         cursor = conn.cursor()
-        today = datetime.now().strftime('%Y-%m-%d')
+        today = today_str()
         
         print(f"🔍 DEBUG - 查詢今日餐點：user_id={user_id}, date={today}")
         
-        # 🔧 修正：檢查表格結構
-        cursor.execute("PRAGMA table_info(meal_records)")
-        columns = [column[1] for column in cursor.fetchall()]
-        print(f"🔍 DEBUG - meal_records 欄位：{columns}")
-        
         cursor.execute('''
             SELECT meal_type, meal_description, nutrition_analysis, 
                    DATE(recorded_at) as meal_date, TIME(recorded_at) as meal_time,
@@ -1273,165 +1763,26 @@ def get_today_meals(user_id):
         if conn:
             conn.close()
 
-def provide_meal_suggestions(event, user_message=""):
-    """提供飲食建議"""
-    user_id = event.source.user_id
-    user = UserManager.get_user(user_id)
+# 🔧 修正3：新增取消處理函數
+def handle_cancel_request(event):
+    """處理取消請求"""
     
-    if not user:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="請先設定個人資料，我才能提供適合你的飲食建議喔！")
-        )
-        return
+    # 清除用戶狀態
+    user_id = event.source.user_id
+    if user_id in user_states:
+        user_states[user_id] = {'step': 'normal'}
     
-    try:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="🤔 讓我想想適合你的餐點...")
-        )
-        
-        # 取得用戶最近飲食和偏好
-        recent_meals = UserManager.get_recent_meals(user_id)
-        food_preferences = UserManager.get_food_preferences(user_id)
-        
-        # 安全地取得用戶資料，避免 None 值和格式化錯誤
-        # ✅ 修正後
-        user_data = get_user_data(user)
-        diabetes_context = f"糖尿病類型：{user_data['diabetes_type']}" if user_data['diabetes_type'] else "無糖尿病"
-
-        user_context = f"""
-用戶資料：{user_data['name']}，{user_data['age']}歲，{user_data['gender']}
-身高：{user_data['height']}cm，體重：{user_data['weight']}kg，體脂率：{user_data['body_fat_percentage']:.1f}%
-活動量：{user_data['activity_level']}
-健康目標：{user_data['health_goals']}
-飲食限制：{user_data['dietary_restrictions']}
-{diabetes_context}
+    cancel_text = """好的！👌
 
-每日營養目標：
-熱量：{user_data['target_calories']:.0f}大卡，碳水：{user_data['target_carbs']:.0f}g，蛋白質：{user_data['target_protein']:.0f}g，脂肪：{user_data['target_fat']:.0f}g
+我一直都在，有任何問題歡迎再來詢問！
 
-最近3天飲食：
-{chr(10).join([f"- {meal[0]}" for meal in recent_meals[:5]])}
+🎯 你可以隨時：
+• 記錄飲食獲得營養分析
+• 詢問飲食建議
+• 諮詢食物相關問題
+• 查看今日進度或週報告
 
-常吃食物：
-{chr(10).join([f"- {pref[0]} (吃過{pref[1]}次)" for pref in food_preferences[:5]])}
-
-用戶詢問：{user_message}
-"""
-
-        # 修改後的建議 Prompt
-        suggestion_prompt = """
-你是擁有20年經驗的專業營養師，特別專精糖尿病醣類控制。請根據用戶的個人資料、飲食習慣和詢問，提供個人化的餐點建議。
-
-重要要求：
-1. 每個食物都必須提供明確的份量指示
-2. 使用純文字格式，不要使用任何 Markdown 符號（如 #、*、、- 等）
-3. 使用表情符號和空行來區分段落
-
-份量表達方式：
-🍚 主食類：
-白飯/糙米飯：1碗 = 1個拳頭大 = 約150-200g = 約200-250大卡
-麵條：1份 = 約100g乾重 = 煮熟後約200g
-吐司：1片全麥吐司 = 約30g = 約80大卡
-
-🥩 蛋白質類：
-雞胸肉：1份 = 1個手掌大小厚度 = 約100-120g = 約120-150大卡
-魚類：1份 = 手掌大小 = 約100g = 約100-150大卡
-蛋：1顆雞蛋 = 約50g = 約70大卡
-豆腐：1塊 = 手掌大小 = 約100g = 約80大卡
-
-🥬 蔬菜類：
-綠葉蔬菜：1份 = 煮熟後約100g = 生菜約200g = 約25大卡
-根莖類：1份 = 約100g = 約50-80大卡
-
-🥛 其他：
-堅果：1份 = 約30g = 約1湯匙 = 約180大卡
-油：1茶匙 = 約5ml = 約45大卡
-
-糖尿病患者特別注意：
-優先推薦低GI食物、碳水化合物份量要精確控制、建議少量多餐、避免精製糖和高糖食物
-
-請提供：
-1. 推薦3個適合的完整餐點組合
-2. 每個餐點包含：主食+蛋白質+蔬菜+適量油脂
-3. 每個食物項目都要標明：具體份量（克數）+ 視覺比對（拳頭/手掌等）+ 約略熱量
-4. 總熱量估算和營養素分配
-5. 考慮用戶的健康目標和飲食限制
-6. 避免重複最近吃過的食物
-7. 提供簡單的製作方式或購買建議
-8. 說明選擇這些餐點的營養理由
-
-回應格式範例：
-🍽️ 餐點1：烤雞胸肉餐
-
-🍚 主食：糙米飯 1碗（150g）= 1拳頭大 = 約220大卡
-🥩 蛋白質：烤雞胸肉 1份（120g）= 手掌大厚度 = 約150大卡  
-🥬 蔬菜：炒青菜 1份（100g）= 約30大卡
-🥄 油脂：橄欖油 1茶匙（5ml）= 約45大卡
-
-總熱量：約445大卡
-
-🍳 製作方式：雞胸肉用香料調味烤15分鐘，青菜熱炒3分鐘即可
-
-💡 選擇理由：低脂高蛋白，適合減重目標
-
-請用純文字格式回應，不要使用 # *  - 等符號，多用表情符號和空行讓內容清晰易讀。
-"""
-        
-        # 使用 OpenAI 生成建議
-        try:
-            from openai import OpenAI
-            client = OpenAI(api_key=OPENAI_API_KEY)
-            
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": suggestion_prompt},
-                    {"role": "user", "content": user_context}
-                ],
-                max_tokens=1200,  # 增加 tokens 以容納詳細份量說明
-                temperature=0.8
-            )
-            
-            suggestions = response.choices[0].message.content
-            
-        except Exception as openai_error:
-            suggestions = generate_detailed_meal_suggestions(user, recent_meals, food_preferences)
-        
-        line_bot_api.push_message(
-            event.source.user_id,
-            TextSendMessage(text=f"🍽️ 為你推薦的餐點：\n\n{suggestions}")
-        )
-        
-    except Exception as e:
-        error_message = f"抱歉，推薦功能出現問題：{str(e)}\n\n請稍後再試或直接詢問特定餐點建議。"
-        
-        line_bot_api.push_message(
-            event.source.user_id,
-            TextSendMessage(text=error_message)
-        )
-
-# 🔧 修正3：新增取消處理函數
-def handle_cancel_request(event):
-    """處理取消請求"""
-    
-    # 清除用戶狀態
-    user_id = event.source.user_id
-    if user_id in user_states:
-        user_states[user_id] = {'step': 'normal'}
-    
-    cancel_text = """好的！👌
-
-我一直都在，有任何問題歡迎再來詢問！
-
-🎯 你可以隨時：
-• 記錄飲食獲得營養分析
-• 詢問飲食建議
-• 諮詢食物相關問題
-• 查看今日進度或週報告
-
-有需要幫助的時候再叫我～ 😊"""
+有需要幫助的時候再叫我～ 😊"""
 
     quick_reply = QuickReply(items=[
         QuickReplyButton(action=MessageAction(label="🍽️ 飲食建議", text="飲食建議")),
@@ -1485,158 +1836,6 @@ def handle_food_record_request(event):
     )
 
 
-def provide_food_consultation(event, user_question):
-    """提供食物諮詢"""
-    user_id = event.source.user_id
-    user = UserManager.get_user(user_id)
-    
-    try:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="🤔 讓我分析一下這個問題...")
-        )
-        
-        # 準備用戶背景資訊
-        if user:
-            user_data = get_user_data(user)
-            diabetes_context = f"糖尿病類型：{user_data['diabetes_type']}" if user_data['diabetes_type'] else "無糖尿病"
-            user_context = f"""
-用戶資料：{user_data['name']}，{user_data['age']}歲，{user_data['gender']}
-身高：{user_data['height']}cm，體重：{user_data['weight']}kg，體脂率：{user_data['body_fat_percentage']:.1f}%
-活動量：{user_data['activity_level']}
-健康目標：{user_data['health_goals']}
-飲食限制：{user_data['dietary_restrictions']}
-{diabetes_context}
-"""
-        else:
-            user_context = "用戶未設定個人資料，請提供一般性建議。"
-        
-        # 修改後的諮詢 Prompt
-        consultation_prompt = f"""
-你是擁有20年經驗的專業營養師，特別專精糖尿病醣類控制。請回答用戶關於食物的問題。
-
-{user_context}
-
-重要要求：
-1. 如果涉及份量建議，必須提供明確的份量指示
-2. 使用純文字格式，不要使用任何 Markdown 符號
-3. 使用表情符號區分段落
-
-份量參考：
-🍚 主食: 1碗飯 = 1拳頭 = 150-200g
-🥩 蛋白質: 1份肉類 = 1手掌大小厚度 = 100-120g  
-🥬 蔬菜: 1份 = 煮熟後100g = 生菜200g
-🥜 堅果: 1份 = 30g = 約1湯匙
-🥛 飲品: 1杯 = 250ml
-
-糖尿病患者特別考量：
-重點關注血糖影響、提供GI值參考、建議適合的食用時間、給出血糖監測建議
-
-請提供：
-1. 直接回答用戶的問題（可以吃/不建議/適量等）
-2. 說明原因（營養成分、健康影響）  
-3. 如果可以吃，明確建議份量：
-   具體重量（克數）
-   視覺比對（拳頭/手掌/湯匙等）
-   建議頻率（每天/每週幾次）
-   最佳食用時間
-4. 如果不建議，提供份量明確的替代選項
-5. 針對用戶健康狀況的特別提醒
-
-回應格式範例：
-💡 關於香蕉的建議
-
-✅ 可以適量食用
-
-🍌 建議份量：半根中型香蕉（約60g）= 約60大卡
-
-⏰ 最佳時機：運動後30分鐘或兩餐之間
-
-🩺 糖尿病注意：香蕉GI值中等，建議搭配堅果一起吃可緩解血糖上升
-
-請用純文字格式，多用表情符號，不要使用 # *  等符號。
-"""
-        
-        # 使用 OpenAI 分析
-        try:
-            from openai import OpenAI
-            client = OpenAI(api_key=OPENAI_API_KEY)
-            
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": consultation_prompt},
-                    {"role": "user", "content": f"用戶問題：{user_question}"}
-                ],
-                max_tokens=800,
-                temperature=0.7
-            )
-            
-            consultation_result = response.choices[0].message.content
-            
-        except Exception as openai_error:
-            consultation_result = generate_detailed_food_consultation(user_question, user)
-        
-        line_bot_api.push_message(
-            event.source.user_id,
-            TextSendMessage(text=f"💡 營養師建議：\n\n{consultation_result}")
-        )
-        
-    except Exception as e:
-        error_message = f"抱歉，諮詢功能出現問題：{str(e)}\n\n請重新描述你的問題，我會盡力回答。"
-        
-        line_bot_api.push_message(
-            event.source.user_id,
-            TextSendMessage(text=error_message)
-        )
-
-def generate_basic_meal_suggestions(user, recent_meals, food_preferences):
-    """API 不可用時的基本餐點建議"""
-    
-    health_goal = user[7] if user[7] else "維持健康"
-    restrictions = user[8] if user[8] else "無"
-    
-    suggestions = f"""根據你的健康目標「{health_goal}」，推薦以下餐點：
-
-🥗 均衡餐點建議：
-• 糙米飯 + 蒸魚 + 炒青菜
-• 雞胸肉沙拉 + 全麥麵包
-• 豆腐味噌湯 + 烤蔬菜
-
-🍎 健康點心：
-• 堅果優格
-• 水果拼盤
-• 無糖豆漿
-
-💡 注意事項：
-• 飲食限制：{restrictions}
-• 建議少油少鹽
-• 多攝取蔬果和蛋白質
-
-詳細營養分析功能暫時無法使用，以上為一般性建議。"""
-    
-    return suggestions
-
-def generate_basic_food_consultation(question, user):
-    """API 不可用時的基本食物諮詢"""
-    
-    consultation = f"""關於你的問題「{question}」：
-
-💡 一般建議：
-• 任何食物都要適量攝取
-• 注意個人健康狀況
-• 均衡飲食最重要
-
-📋 建議做法：
-• 如有特殊疾病，請諮詢醫師
-• 注意份量控制
-• 選擇天然原型食物
-
-⚠️ 特別提醒：
-詳細營養諮詢功能暫時無法使用，建議諮詢專業營養師或醫師獲得個人化建議。"""
-    
-    return consultation
-
 # 其他原有功能保持不變...
 def start_profile_setup(event):
     user_id = event.source.user_id
@@ -1647,6 +1846,44 @@ def start_profile_setup(event):
         TextSendMessage(text="📝 讓我為你建立個人營養檔案！\n\n請告訴我你的姓名：")
     )
 
+# 從輸入中取出第一段數字（例如「25歲」→ 25）
+_DIGIT_RE = re.compile(r'\d+')
+
+# 個人資料設定時可接受的性別、活動量輸入（已轉小寫並去除空白）
+GENDER_ALIASES = {
+    **dict.fromkeys(['男性', '男', 'male', 'm', '1', '先生'], '男性'),
+    **dict.fromkeys(['女性', '女', 'female', 'f', '2', '小姐'], '女性'),
+}
+
+ACTIVITY_ALIASES = {
+    **dict.fromkeys(['低活動量', '低', 'low', '1', '很少運動', '久坐'], '低活動量'),
+    **dict.fromkeys(['中等活動量', '中等', '中', 'medium', '2', '適度運動'], '中等活動量'),
+    **dict.fromkeys(['高活動量', '高', 'high', '3', '經常運動', '很多運動'], '高活動量'),
+}
+
+# 個人資料設定流程共用的快速回覆按鈕（內容固定，模組載入時建立一次）
+_QR_GENDER = QuickReply(items=[
+    QuickReplyButton(action=MessageAction(label="男性", text="男性")),
+    QuickReplyButton(action=MessageAction(label="女性", text="女性"))
+])
+
+_QR_ACTIVITY = QuickReply(items=[
+    QuickReplyButton(action=MessageAction(label="低活動量", text="低活動量")),
+    QuickReplyButton(action=MessageAction(label="中等活動量", text="中等活動量")),
+    QuickReplyButton(action=MessageAction(label="高活動量", text="高活動量"))
+])
+
+_QR_BODY_FAT_BUTTONS = (
+    QuickReplyButton(action=MessageAction(label="輸入實測值", text="實測值")),
+    QuickReplyButton(action=MessageAction(label="跳過此項", text="跳過體脂"))
+)
+
+_QR_POST_SETUP = QuickReply(items=[
+    QuickReplyButton(action=MessageAction(label="飲食建議", text="等等可以吃什麼？")),
+    QuickReplyButton(action=MessageAction(label="食物諮詢", text="我可以吃巧克力嗎？")),
+    QuickReplyButton(action=MessageAction(label="使用說明", text="使用說明"))
+])
+
 def handle_profile_setup_flow(event, message_text):
     user_id = event.source.user_id
     current_step = user_states[user_id]['step']
@@ -1661,26 +1898,24 @@ def handle_profile_setup_flow(event, message_text):
     
     elif current_step == 'age':
         try:
-            age = int(re.findall(r'\d+', message_text)[0])  # 提取數字
+            match = _DIGIT_RE.search(message_text)  # 提取數字
+            age = int(match.group()) if match else None
+            if age is None:
+                raise ValueError("找不到年齡數字")
             if 10 <= age <= 120:  # 合理年齡範圍
                 user_states[user_id]['data']['age'] = age
                 user_states[user_id]['step'] = 'gender'
                 
-                quick_reply = QuickReply(items=[
-                    QuickReplyButton(action=MessageAction(label="男性", text="男性")),
-                    QuickReplyButton(action=MessageAction(label="女性", text="女性"))
-                ])
-                
                 line_bot_api.reply_message(
                     event.reply_token,
-                    TextSendMessage(text="請選擇你的性別：", quick_reply=quick_reply)
+                    TextSendMessage(text="請選擇你的性別：", quick_reply=_QR_GENDER)
                 )
             else:
                 line_bot_api.reply_message(
                     event.reply_token,
                     TextSendMessage(text="年齡請輸入10-120之間的數字：")
                 )
-        except (ValueError, IndexError):
+        except ValueError:
             line_bot_api.reply_message(
                 event.reply_token,
                 TextSendMessage(text="請輸入有效的年齡數字（例如：25）：")
@@ -1688,22 +1923,13 @@ def handle_profile_setup_flow(event, message_text):
     
     elif current_step == 'gender':
         # 智能識別性別輸入
-        message_lower = message_text.lower().strip()
+        gender = GENDER_ALIASES.get(message_text.lower().strip())
         
-        if message_lower in ['男性', '男', 'male', 'm', '1', '先生']:
-            gender = '男性'
-        elif message_lower in ['女性', '女', 'female', 'f', '2', '小姐']:
-            gender = '女性'
-        else:
+        if not gender:
             # 無法識別時，重新詢問
-            quick_reply = QuickReply(items=[
-                QuickReplyButton(action=MessageAction(label="男性", text="男性")),
-                QuickReplyButton(action=MessageAction(label="女性", text="女性"))
-            ])
-            
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text="請選擇你的性別（請點選下方按鈕或輸入「男性」、「女性」）：", quick_reply=quick_reply)
+                TextSendMessage(text="請選擇你的性別（請點選下方按鈕或輸入「男性」、「女性」）：", quick_reply=_QR_GENDER)
             )
             return
         
@@ -1748,10 +1974,14 @@ def handle_profile_setup_flow(event, message_text):
             
             estimated_body_fat = max(5, min(50, estimated_body_fat))
             
+            # 記下 BMI 與估算值，之後的步驟直接使用，不必重新計算
+            data['bmi'] = bmi
+            data['estimated_body_fat'] = estimated_body_fat
+            
+            # 只有估算值按鈕需要依用戶資料產生，其餘兩個按鈕共用
             quick_reply = QuickReply(items=[
                 QuickReplyButton(action=MessageAction(label=f"使用估算值 {estimated_body_fat:.1f}%", text=f"估算 {estimated_body_fat:.1f}")),
-                QuickReplyButton(action=MessageAction(label="輸入實測值", text="實測值")),
-                QuickReplyButton(action=MessageAction(label="跳過此項", text="跳過體脂"))
+                *_QR_BODY_FAT_BUTTONS
             ])
             
             line_bot_api.reply_message(
@@ -1766,29 +1996,14 @@ def handle_profile_setup_flow(event, message_text):
 
     elif current_step == 'body_fat':
         if "估算" in message_text:
-            # 使用估算值
+            # 使用估算值（體重步驟已算好）
             data = user_states[user_id]['data']
-            height_m = data['height'] / 100
-            bmi = data['weight'] / (height_m ** 2)
-            
-            if data['gender'] == '男性':
-                body_fat = (1.20 * bmi) + (0.23 * data['age']) - 16.2
-            else:
-                body_fat = (1.20 * bmi) + (0.23 * data['age']) - 5.4
-            
-            body_fat = max(5, min(50, body_fat))
-            user_states[user_id]['data']['body_fat_percentage'] = body_fat
+            user_states[user_id]['data']['body_fat_percentage'] = data['estimated_body_fat']
             user_states[user_id]['step'] = 'activity'
             
-            quick_reply = QuickReply(items=[
-                QuickReplyButton(action=MessageAction(label="低活動量", text="低活動量")),
-                QuickReplyButton(action=MessageAction(label="中等活動量", text="中等活動量")),
-                QuickReplyButton(action=MessageAction(label="高活動量", text="高活動量"))
-            ])
-            
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text="請選擇你的活動量：", quick_reply=quick_reply)
+                TextSendMessage(text="請選擇你的活動量：", quick_reply=_QR_ACTIVITY)
             )
         elif "實測值" in message_text:
             user_states[user_id]['step'] = 'body_fat_input'
@@ -1800,15 +2015,9 @@ def handle_profile_setup_flow(event, message_text):
             user_states[user_id]['data']['body_fat_percentage'] = 0
             user_states[user_id]['step'] = 'activity'
             
-            quick_reply = QuickReply(items=[
-                QuickReplyButton(action=MessageAction(label="低活動量", text="低活動量")),
-                QuickReplyButton(action=MessageAction(label="中等活動量", text="中等活動量")),
-                QuickReplyButton(action=MessageAction(label="高活動量", text="高活動量"))
-            ])
-            
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text="請選擇你的活動量：", quick_reply=quick_reply)
+                TextSendMessage(text="請選擇你的活動量：", quick_reply=_QR_ACTIVITY)
             )
 
     elif current_step == 'body_fat_input':
@@ -1818,15 +2027,9 @@ def handle_profile_setup_flow(event, message_text):
                 user_states[user_id]['data']['body_fat_percentage'] = body_fat
                 user_states[user_id]['step'] = 'activity'
                 
-                quick_reply = QuickReply(items=[
-                    QuickReplyButton(action=MessageAction(label="低活動量", text="低活動量")),
-                    QuickReplyButton(action=MessageAction(label="中等活動量", text="中等活動量")),
-                    QuickReplyButton(action=MessageAction(label="高活動量", text="高活動量"))
-                ])
-                
                 line_bot_api.reply_message(
                     event.reply_token,
-                    TextSendMessage(text="請選擇你的活動量：", quick_reply=quick_reply)
+                    TextSendMessage(text="請選擇你的活動量：", quick_reply=_QR_ACTIVITY)
                 )
             else:
                 line_bot_api.reply_message(
@@ -1841,25 +2044,13 @@ def handle_profile_setup_flow(event, message_text):
     
     elif current_step == 'activity':
         # 智能識別活動量輸入
-        message_lower = message_text.lower().strip()
-        
-        if message_lower in ['低活動量', '低', 'low', '1', '很少運動', '久坐']:
-            activity = '低活動量'
-        elif message_lower in ['中等活動量', '中等', '中', 'medium', '2', '適度運動']:
-            activity = '中等活動量'
-        elif message_lower in ['高活動量', '高', 'high', '3', '經常運動', '很多運動']:
-            activity = '高活動量'
-        else:
+        activity = ACTIVITY_ALIASES.get(message_text.lower().strip())
+        
+        if not activity:
             # 無法識別時，重新詢問
-            quick_reply = QuickReply(items=[
-                QuickReplyButton(action=MessageAction(label="低活動量", text="低活動量")),
-                QuickReplyButton(action=MessageAction(label="中等活動量", text="中等活動量")),
-                QuickReplyButton(action=MessageAction(label="高活動量", text="高活動量"))
-            ])
-            
             line_bot_api.reply_message(
                 event.reply_token,
-                TextSendMessage(text="請選擇你的活動量：\n\n低活動量(1)：很少運動\n中等活動量(2)：每週運動2-3次\n高活動量(3)：每天都運動\n\n請點選按鈕或輸入數字1-3：", quick_reply=quick_reply)
+                TextSendMessage(text="請選擇你的活動量：\n\n低活動量(1)：很少運動\n中等活動量(2)：每週運動2-3次\n高活動量(3)：每天都運動\n\n請點選按鈕或輸入數字1-3：", quick_reply=_QR_ACTIVITY)
             )
             return
         
@@ -1885,9 +2076,9 @@ def handle_profile_setup_flow(event, message_text):
         UserManager.save_user(user_id, user_states[user_id]['data'])
         user_states[user_id]['step'] = 'normal'
         
-        # 計算 BMI
+        # BMI 已在體重步驟算好
         data = user_states[user_id]['data']
-        bmi = data['weight'] / ((data['height'] / 100) ** 2)
+        bmi = data['bmi']
         
         completion_text = f"""✅ 個人資料設定完成！
 
@@ -1907,85 +2098,28 @@ def handle_profile_setup_flow(event, message_text):
 🍽️ 詢問餐點建議
 ❓ 諮詢食物問題"""
         
-        quick_reply = QuickReply(items=[
-            QuickReplyButton(action=MessageAction(label="飲食建議", text="等等可以吃什麼？")),
-            QuickReplyButton(action=MessageAction(label="食物諮詢", text="我可以吃巧克力嗎？")),
-            QuickReplyButton(action=MessageAction(label="使用說明", text="使用說明"))
-        ])
-        
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=completion_text, quick_reply=quick_reply)
-        )
-
-def show_user_profile(event):
-    user_id = event.source.user_id
-    user = UserManager.get_user(user_id)
-    
-    if not user:
         line_bot_api.reply_message(
             event.reply_token,
-            TextSendMessage(text="你還沒有設定個人資料。請先點選「設定個人資料」。")
+            TextSendMessage(text=completion_text, quick_reply=_QR_POST_SETUP)
         )
-        return
-    
-    user_data = get_user_data(user)
-    bmi = user_data['weight'] / ((user_data['height'] / 100) ** 2)
-
-    profile_text = f"""👤 你的個人資料：
-
-- 姓名：{user_data['name']}
-- 年齡：{user_data['age']} 歲  
-- 性別：{user_data['gender']}
-- 身高：{user_data['height']} cm
-- 體重：{user_data['weight']} kg
-- 體脂率：{user_data['body_fat_percentage']:.1f}%
-- BMI：{bmi:.1f}
-- 活動量：{user_data['activity_level']}
-- 健康目標：{user_data['health_goals']}
-- 飲食限制：{user_data['dietary_restrictions']}
 
-💡 想要更新資料，請點選「設定個人資料」重新設定。"""
-    
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=profile_text)
-    )
+# GPT 分析超過這個秒數還沒回來，才先送出等候訊息
+ANALYSIS_PLACEHOLDER_DELAY = 2
+ANALYSIS_PLACEHOLDER_TEXT = "🔍 正在分析你的餐點，請稍候..."
 
 def analyze_food_description_with_confirmation(event, food_description):
     """帶確認流程的飲食分析（修正營養提取版）"""
     user_id = event.source.user_id
-    user = UserManager.get_user(user_id)
     
     print(f"🔍 DEBUG - 用戶輸入：{food_description}")
     
     try:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="🔍 正在分析你的飲食內容，請稍候...")
-        )
-        
         # 判斷餐型
         meal_type = determine_meal_type(food_description)
         print(f"🔍 DEBUG - 判斷餐型：{meal_type}")
         
-        # 建立個人化提示
-        if user:
-            user_data = get_user_data(user)
-            user_context = f"""
-用戶資料：
-- 姓名：{user_data['name']}，{user_data['age']}歲，{user_data['gender']}
-- 身高：{user_data['height']}cm，體重：{user_data['weight']}kg，體脂率：{user_data['body_fat_percentage']:.1f}%
-- 活動量：{user_data['activity_level']}
-- 健康目標：{user_data['health_goals']}
-- 飲食限制：{user_data['dietary_restrictions']}
-- 糖尿病類型：{user_data['diabetes_type'] if user_data['diabetes_type'] else '無'}
-
-每日營養目標：
-熱量：{user_data['target_calories']:.0f}大卡，碳水：{user_data['target_carbs']:.0f}g，蛋白質：{user_data['target_protein']:.0f}g，脂肪：{user_data['target_fat']:.0f}g
-"""
-        else:
-            user_context = "用戶未設定個人資料，請提供一般性建議。"
+        # 建立個人化提示（依用戶資料版本快取）
+        user_context = get_profile_context(user_id, 'analysis')
         
         # 使用營養分析 Prompt
         nutrition_prompt = get_updated_nutrition_prompt(user_context)
@@ -1994,22 +2128,36 @@ def analyze_food_description_with_confirmation(event, food_description):
         nutrition_data = None
         analysis_result = ""
 
-        # 使用 OpenAI 分析
+        # 使用 OpenAI 分析（相同內容與背景資料的分析結果直接使用快取）
         try:
-            from openai import OpenAI
-            client = OpenAI(api_key=OPENAI_API_KEY)
-            
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": nutrition_prompt},
-                    {"role": "user", "content": f"請分析以下{meal_type}：{food_description}"}
-                ],
-                max_tokens=1000,
-                temperature=0.7
-            )
+            cache_key = prompt_cache_key("analyze", f"{meal_type}：{food_description}", user_context)
+            cached_analysis = None if should_bypass_cache(food_description) else PROMPT_CACHE.get(cache_key)
             
-            analysis_result = response.choices[0].message.content
+            if cached_analysis is not None:
+                analysis_result = cached_analysis
+            else:
+                # 確認訊息需要完整的分析結果才能提取營養數據，不串流；
+                # 改走批次佇列，LINE 重送的相同 webhook 只會呼叫一次 API
+                analysis_future = GPT_BATCH.submit(
+                    model=CHAT_MODEL,
+                    messages=[
+                        {"role": "system", "content": nutrition_prompt},
+                        {"role": "user", "content": f"請分析以下{meal_type}：{food_description}"}
+                    ],
+                    max_tokens=600,
+                    timeout=CHAT_REQUEST_TIMEOUT,
+                    temperature=0.7
+                )
+                # 大多數分析幾秒內完成，直接用 reply 送確認訊息；太久才先回覆等候訊息，確認訊息改為推播
+                try:
+                    response = analysis_future.result(timeout=ANALYSIS_PLACEHOLDER_DELAY)
+                except FutureTimeoutError:
+                    reply_or_push(event, TextSendMessage(text=ANALYSIS_PLACEHOLDER_TEXT))
+                    # 等待設上限，重試都用完仍沒有結果就改用下方的推測數據
+                    response = analysis_future.result(timeout=CHAT_RESULT_TIMEOUT)
+                
+                analysis_result = response.choices[0].message.content
+                PROMPT_CACHE[cache_key] = analysis_result
             print(f"🔍 DEBUG - AI分析結果：{analysis_result}")
             
             # 🔧 重要修正：從完整的分析結果中提取營養數據
@@ -2029,10 +2177,10 @@ def analyze_food_description_with_confirmation(event, food_description):
                 nutrition_data = smart_estimate_nutrition_from_description(food_description)
                 print(f"🔧 DEBUG - 智能推測的營養數據：{nutrition_data}")
             
-        except Exception as openai_error:
-            print(f"🔍 DEBUG - OpenAI錯誤：{openai_error}")
+        except (OpenAIError, FutureTimeoutError) as openai_error:
+            print(f"🔍 DEBUG - OpenAI錯誤或逾時：{openai_error!r}")
             
-            # API失敗時使用智能推測
+            # API失敗或逾時都使用智能推測
             nutrition_data = smart_estimate_nutrition_from_description(food_description)
             analysis_result = f"系統分析：{food_description}\n\n基於食物資料庫估算營養成分"
         
@@ -2062,20 +2210,13 @@ def analyze_food_description_with_confirmation(event, food_description):
         print(f"🔍 DEBUG - 系統錯誤：{e}")
         error_message = f"抱歉，分析出現問題：{str(e)}\n\n請重新描述你的飲食內容。"
         
-        line_bot_api.push_message(
-            event.source.user_id,
-            TextSendMessage(text=error_message)
-        )
+        reply_or_push(event, TextSendMessage(text=error_message))
 
 # 🔧 新增：強制從文本中提取營養數據的函數
-def force_extract_nutrition_from_text(text):
-    """強制從分析文本中提取營養數據，使用更靈活的模式"""
-    import re
-    
-    print(f"🔍 DEBUG - 強制提取營養數據：{text}")
-    
-    # 更寬鬆的正則表達式模式
-    patterns = {
+# 更寬鬆的正則表達式模式（模組載入時預先編譯）
+FORCE_NUTRITION_PATTERNS = {
+    nutrient: tuple(re.compile(pattern, re.IGNORECASE) for pattern in pattern_list)
+    for nutrient, pattern_list in {
         'calories': [
             r'熱量[:：]?\s*約?(\d+(?:\.\d+)?)\s*大卡',
             r'約\s*(\d+(?:\.\d+)?)\s*大卡',
@@ -2100,23 +2241,29 @@ def force_extract_nutrition_from_text(text):
             r'膳食纖維[:：]?\s*約?(\d+(?:\.\d+)?)\s*g',
             r'纖維\s*(\d+)\s*g'
         ]
-    }
+    }.items()
+}
+
+def force_extract_nutrition_from_text(text):
+    """強制從分析文本中提取營養數據，使用更靈活的模式"""
+    print(f"🔍 DEBUG - 強制提取營養數據：{text}")
     
     def force_extract_value(patterns_list, text):
         for pattern in patterns_list:
-            matches = re.findall(pattern, text, re.IGNORECASE)
-            if matches:
+            # search 找到第一個符合就停止，不必建立所有結果的 list
+            match = pattern.search(text)
+            if match:
                 try:
-                    value = float(matches[0])
-                    print(f"🔧 DEBUG - 強制提取成功 {pattern}: {value}")
+                    value = float(match.group(1))
+                    print(f"🔧 DEBUG - 強制提取成功 {pattern.pattern}: {value}")
                     return value
-                except (ValueError, IndexError):
+                except ValueError:
                     continue
         return 0
     
     # 強制提取各營養素
     nutrition_data = {}
-    for nutrient, pattern_list in patterns.items():
+    for nutrient, pattern_list in FORCE_NUTRITION_PATTERNS.items():
         value = force_extract_value(pattern_list, text)
         nutrition_data[nutrient] = value
         print(f"🔧 DEBUG - {nutrient} 強制提取結果: {value}")
@@ -2232,10 +2379,8 @@ def emergency_nutrition_fallback(food_description):
     return fallback_nutrition
 
 # 🔧 修正2：更新營養分析 Prompt，加入份量預設邏輯
-def get_updated_nutrition_prompt(user_context):
-    """取得更新的營養分析提示，包含份量預設邏輯"""
-    
-    return f"""
+# 營養分析 Prompt（模組層級常數，只替換用戶背景資料）
+NUTRITION_PROMPT_TEMPLATE = """
 你是一位擁有20年經驗的專業營養師，特別專精糖尿病醣類控制。請根據用戶實際吃的食物進行分析。
 
 {user_context}
@@ -2313,6 +2458,11 @@ def get_updated_nutrition_prompt(user_context):
 確保營養數據的合理性
 """
 
+def get_updated_nutrition_prompt(user_context):
+    """取得更新的營養分析提示，包含份量預設邏輯"""
+    
+    return NUTRITION_PROMPT_TEMPLATE.format(user_context=user_context)
+
 # 🔧 新增：顯示記錄確認的函數
 def show_meal_record_confirmation(event, user_id, meal_type, food_description, analysis_result, nutrition_data):
     """顯示飲食記錄確認訊息（確保營養數據正確版）"""
@@ -2384,69 +2534,7 @@ def show_meal_record_confirmation(event, user_id, meal_type, food_description, a
         QuickReplyButton(action=MessageAction(label="❌ 錯誤，重新輸入", text="❌ 錯誤，重新輸入"))
     ])
     
-    line_bot_api.push_message(
-        event.source.user_id,
-        TextSendMessage(text=confirmation_display, quick_reply=quick_reply)
-    )
-
-def extract_nutrition_from_analysis(analysis_text):
-    """從分析文本中提取營養數據（保留份量校正的加強版）"""
-    import re
-    
-    print(f"🔍 DEBUG - 開始提取營養數據從：{analysis_text[:200]}...")
-    
-    # 更全面的正則表達式提取
-    patterns = {
-        'calories': [
-            r'熱量[:：]\s*約?(\d+(?:\.\d+)?)\s*大卡',
-            r'總熱量[:：]\s*約?(\d+(?:\.\d+)?)\s*大卡',
-            r'約(\d+(?:\.\d+)?)\s*大卡',
-            r'(\d+(?:\.\d+)?)\s*大卡'
-        ],
-        'carbs': [
-            r'碳水化合物[:：]\s*約?(\d+(?:\.\d+)?)\s*g',
-            r'碳水[:：]\s*約?(\d+(?:\.\d+)?)\s*g'
-        ],
-        'protein': [
-            r'蛋白質[:：]\s*約?(\d+(?:\.\d+)?)\s*g'
-        ],
-        'fat': [
-            r'脂肪[:：]\s*約?(\d+(?:\.\d+)?)\s*g'
-        ],
-        'fiber': [
-            r'纖維[:：]\s*約?(\d+(?:\.\d+)?)\s*g',
-            r'膳食纖維[:：]\s*約?(\d+(?:\.\d+)?)\s*g'
-        ],
-        'sugar': [
-            r'糖[:：]\s*約?(\d+(?:\.\d+)?)\s*g',
-            r'糖分[:：]\s*約?(\d+(?:\.\d+)?)\s*g'
-        ]
-    }
-    
-    def extract_value(patterns_list, text, default=0):
-        for pattern in patterns_list:
-            matches = re.findall(pattern, text)
-            if matches:
-                try:
-                    # 取第一個匹配的數值
-                    value = float(matches[0])
-                    print(f"🔍 DEBUG - 提取到 {pattern}: {value}")
-                    return value
-                except (ValueError, IndexError):
-                    continue
-        print(f"⚠️ WARNING - 未能提取數值，使用預設值：{default}")
-        return default
-    
-    # 提取各營養素
-    nutrition_data = {}
-    for nutrient, pattern_list in patterns.items():
-        nutrition_data[nutrient] = extract_value(pattern_list, analysis_text, 
-                                                {'calories': 150, 'carbs': 20, 'protein': 8, 
-                                                 'fat': 5, 'fiber': 2, 'sugar': 5}[nutrient])
-    
-    print(f"🔧 DEBUG - 原始提取的營養數據：{nutrition_data}")
-    return nutrition_data
-
+    reply_or_push(event, TextSendMessage(text=confirmation_display, quick_reply=quick_reply))
 
 def extract_nutrition_from_analysis_with_validation(analysis_text, food_description):
     """從分析文本中提取營養數據，並進行合理性檢查（保留原本份量校正）"""
@@ -2623,93 +2711,8 @@ def get_reasonable_nutrition_data(food_description):
         print(f"🔍 DEBUG - 推測為一般食物：{default_nutrition}（預設1份）")
         return default_nutrition
 
-def determine_meal_type(description):
-    """判斷餐型"""
-    description_lower = description.lower()
-    
-    if any(word in description_lower for word in ['早餐', '早上', '早飯', 'morning']):
-        return '早餐'
-    elif any(word in description_lower for word in ['午餐', '中午', '午飯', 'lunch']):
-        return '午餐'
-    elif any(word in description_lower for word in ['晚餐', '晚上', '晚飯', 'dinner']):
-        return '晚餐'
-    elif any(word in description_lower for word in ['點心', '零食', '下午茶', 'snack']):
-        return '點心'
-    else:
-        return '餐點'
-
-
-def generate_detailed_meal_suggestions(user, recent_meals, food_preferences):
-    """API 不可用時的詳細餐點建議"""
-    
-    health_goal = user[7] if user[7] else "維持健康"
-    restrictions = user[8] if user[8] else "無"
-    
-    suggestions = f"""根據你的健康目標「{health_goal}」，推薦以下餐點：
-
-🥗 均衡餐點建議（含精確份量）：
-
-🍽️ 選項1：蒸魚餐
-- 糙米飯：1碗 = 1拳頭大 = 約180g = 約220大卡
-- 蒸鮭魚：1片 = 手掌大厚度 = 約120g = 約180大卡  
-- 炒青菜：1份 = 煮熟後100g = 約30大卡
-- 橄欖油：1茶匙 = 5ml = 約45大卡
-📊 總熱量：約475大卡
-
-🍽️ 選項2：雞胸肉沙拉
-- 雞胸肉：1份 = 手掌大 = 約100g = 約165大卡
-- 生菜沙拉：2碗 = 約200g = 約30大卡
-- 全麥麵包：1片 = 約30g = 約80大卡
-- 堅果：1湯匙 = 約15g = 約90大卡
-📊 總熱量：約365大卡
-
-💡 份量調整原則：
-• 減重：減少主食至半碗（90g）
-• 增重：增加蛋白質至1.5份（150g）
-• 控糖：選擇低GI主食，控制在100g以內
-
-⚠️ 飲食限制考量：{restrictions}
-
-詳細營養分析功能暫時無法使用，以上為精確份量建議。"""
-    
-    return suggestions
-
-
-def generate_detailed_food_consultation(question, user):
-    """API 不可用時的詳細食物諮詢"""
-    
-    consultation = f"""關於你的問題「{question}」：
-
-💡 一般建議與份量指示：
-
-🔸 基本原則：
-• 任何食物都要適量攝取
-• 注意個人健康狀況
-• 均衡飲食最重要
-
-🔸 常見食物份量參考：
-• 水果：1份 = 1個拳頭大 = 約150g
-• 堅果：1份 = 1湯匙 = 約30g  
-• 全穀物：1份 = 1拳頭 = 約150-200g
-• 蛋白質：1份 = 1手掌厚度 = 約100-120g
-
-⚠️ 特別提醒：
-• 如有特殊疾病，請諮詢醫師
-• 注意個人過敏原
-• 逐漸調整份量，避免突然改變
-
-📋 建議做法：
-• 使用食物秤確認重量
-• 學會視覺估量
-• 記錄飲食反應
-
-詳細營養諮詢功能暫時無法使用，建議諮詢專業營養師獲得個人化建議。"""
-    
-    return consultation
-
-
-class ReminderSystem:
-    """提醒系統"""
+class ReminderSystem:
+    """提醒系統"""
     
     @staticmethod
     def send_daily_reminder():
@@ -2744,9 +2747,6 @@ class EmailReporter:
 
 def schedule_tasks():
     """排程任務"""
-    import schedule
-    import time
-    
     # 每日9點發送提醒
     schedule.every().day.at("09:00").do(ReminderSystem.send_daily_reminder)
     
@@ -2756,13 +2756,17 @@ def schedule_tasks():
     # 每日23點發送使用報告
     schedule.every().day.at("23:00").do(EmailReporter.generate_daily_report)
     
+    # 每10分鐘 ping 一次，保持服務活躍
+    schedule.every(10).minutes.do(keep_alive)
+    
     while True:
         schedule.run_pending()
-        time.sleep(60)
+        # 直接睡到下一個任務的時間：不必每分鐘醒來檢查，09:00 的任務也不會延遲最多一分鐘
+        idle_seconds = schedule.idle_seconds()
+        time.sleep(max(0, idle_seconds) if idle_seconds is not None else 60)
 
 def start_scheduler():
     """啟動排程器"""
-    import threading
     try:
         scheduler_thread = threading.Thread(target=schedule_tasks)
         scheduler_thread.daemon = True
@@ -2773,267 +2777,8 @@ def start_scheduler():
 
 
 
-def generate_weekly_report(event):
-    user_id = event.source.user_id
-    user = UserManager.get_user(user_id)
-    
-    if not user:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="請先設定個人資料才能產生週報告。")
-        )
-        return
-    
-    # 取得本週飲食記錄
-    weekly_meals = UserManager.get_weekly_meals(user_id)
-    
-    if not weekly_meals:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="本週還沒有飲食記錄。開始記錄你的飲食，下週就能看到詳細報告了！")
-        )
-        return
-    
-    # 生成週報告
-    try:
-        from openai import OpenAI
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        
-        # 準備本週飲食資料
-        meals_by_type = {}
-        for meal in weekly_meals:
-            meal_type = meal[0]
-            if meal_type not in meals_by_type:
-                meals_by_type[meal_type] = []
-            meals_by_type[meal_type].append(meal[1])
-        
-        meals_summary = ""
-        for meal_type, meals in meals_by_type.items():
-            meals_summary += f"\n{meal_type}：\n"
-            for meal in meals[:3]:  # 只顯示前3個
-                meals_summary += f"- {meal}\n"
-        
-        user_data = get_user_data(user)
-        diabetes_context = f"糖尿病類型：{user_data['diabetes_type']}" if user_data['diabetes_type'] else "無糖尿病"
-
-        user_context = f"""
-用戶資料：{user_data['name']}，{user_data['age']}歲，{user_data['gender']}
-身高：{user_data['height']}cm，體重：{user_data['weight']}kg
-活動量：{user_data['activity_level']}
-健康目標：{user_data['health_goals']}
-飲食限制：{user_data['dietary_restrictions']}
-{diabetes_context}
-
-記錄期間：{record_days}天（共{total_meals}餐）
-餐型分佈：{dict(meal_counts)}
-
-詳細飲食記錄：
-{meals_summary}
-""" 
-        
-        report_prompt = """
-作為專業營養師，請為用戶生成本週營養分析報告：
-
-1. 本週飲食總結與亮點
-2. 營養攝取評估（優點與不足）
-3. 與健康目標的對比分析
-4. 具體改善建議（3-5點）
-5. 下週飲食規劃建議
-
-請提供具體、實用的建議，語調要專業而親切。
-"""
-        
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": report_prompt},
-                {"role": "user", "content": user_context}
-            ],
-            max_tokens=1000,
-            temperature=0.7
-        )
-        
-        report = response.choices[0].message.content
-        
-        final_report = f"""📊 本週營養分析報告
-記錄天數：{len(set(meal[3][:10] for meal in weekly_meals))} 天
-總餐數：{len(weekly_meals)} 餐
-
-{report}
-
-💡 持續記錄飲食，讓我為你提供更準確的營養建議！"""
-        
-    except Exception as e:
-        final_report = f"""📊 本週營養記錄摘要
-記錄天數：{len(set(meal[3][:10] for meal in weekly_meals))} 天
-總餐數：{len(weekly_meals)} 餐
-
-🎯 飲食記錄統計：
-"""
-        
-        # 統計餐型分佈
-        meal_counts = {}
-        for meal in weekly_meals:
-            meal_type = meal[0]
-            meal_counts[meal_type] = meal_counts.get(meal_type, 0) + 1
-        
-        for meal_type, count in meal_counts.items():
-            final_report += f"• {meal_type}：{count} 次\n"
-        
-        final_report += f"""
-💡 一般建議：
-• 保持規律的三餐時間
-• 增加蔬果攝取
-• 注意營養均衡
-• 適量補充水分
-
-詳細分析功能暫時無法使用，請稍後再試。"""
-    
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=final_report)
-    )
-
-def show_instructions(event):
-    instructions = """📋 使用說明
-
-🏥 我是20年經驗營養師，特別專精糖尿病醣類控制
-
-🔹 主要功能：
-📝 記錄飲食：輸入「記錄飲食」或直接描述食物
-🍽️ 飲食建議：「今天晚餐吃什麼？」
-❓ 食物諮詢：「糖尿病可以吃水果嗎？」
-📊 營養追蹤：「今日進度」查看即時攝取
-📈 週報告：「週報告」追蹤營養趨勢
-
-🔹 記錄飲食格式：
-• 包含餐型：早餐/午餐/晚餐/點心
-• 描述食物：具體的食物名稱
-• 註明份量：碗數、片數、杯數等
-
-💬 記錄範例：
-• 「早餐吃了蛋餅一份加豆漿一杯」
-• 「午餐：雞腿便當，有滷蛋和高麗菜」
-• 「下午喝了拿鐵咖啡中杯」
-
-🔹 智慧對話範例：
-• 「不知道要吃什麼」→ 推薦適合餐點
-• 「香蕉適合我嗎？」→ 個人化食物建議
-• 「血糖高能吃什麼？」→ 糖尿病專業建議
-
-🔹 快速指令：
-• 輸入「取消」可隨時取消操作
-• 輸入「重新啟動」可重置對話狀態
-• 輸入「記錄飲食」開始記錄引導
-
-💡 小技巧：
-越詳細的描述，越準確的建議！"""
-    
-    quick_reply = QuickReply(items=[
-        QuickReplyButton(action=MessageAction(label="📝 記錄飲食", text="記錄飲食")),
-        QuickReplyButton(action=MessageAction(label="📊 今日進度", text="今日進度")),
-        QuickReplyButton(action=MessageAction(label="🍽️ 飲食建議", text="飲食建議")),
-        QuickReplyButton(action=MessageAction(label="📈 週報告", text="週報告"))
-    ])
-    
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=instructions, quick_reply=quick_reply)
-    )
-
-@handler.add(MessageEvent, message=ImageMessage)
-def handle_image_message(event):
-    guide_text = """📸 感謝你上傳照片！
-
-為了提供更準確的分析，請用文字描述你的食物：
-
-💬 描述範例：
-• 「白飯一碗 + 紅燒豬肉 + 青菜」
-• 「雞腿便當，有滷蛋和高麗菜」
-• 「拿鐵咖啡中杯 + 全麥吐司」
-
-🤖 或者你可以問我：
-• 「這個便當適合減重嗎？」
-• 「推薦健康的午餐」
-• 「糖尿病可以吃什麼？」
-
-我會根據你的個人資料提供最適合的建議！"""
-    
-    quick_reply = QuickReply(items=[
-        QuickReplyButton(action=MessageAction(label="今日進度", text="今日進度")),
-        QuickReplyButton(action=MessageAction(label="飲食建議", text="等等可以吃什麼？")),
-        QuickReplyButton(action=MessageAction(label="食物諮詢", text="這個食物適合我嗎？"))
-    ])
-    
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=guide_text, quick_reply=quick_reply)
-    )
-
-def provide_meal_suggestions(event, user_message=""):
-    """提供飲食建議"""
-    user_id = event.source.user_id
-    user = UserManager.get_user(user_id)
-    
-    if not user:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="請先設定個人資料，我才能提供適合你的飲食建議喔！")
-        )
-        return
-    
-    try:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="🤔 讓我想想適合你的餐點...")
-        )
-        
-        # 取得用戶最近飲食和偏好
-        recent_meals = UserManager.get_recent_meals(user_id)
-        food_preferences = UserManager.get_food_preferences(user_id)
-        
-        # 安全地處理用戶資料，避免 None 值和索引錯誤
-        user_data = get_user_data(user)
-        name = user_data['name']
-        age = user_data['age']
-        gender = user_data['gender']
-        height = user_data['height']
-        weight = user_data['weight']
-        activity = user_data['activity_level']
-        goals = user_data['health_goals']
-        restrictions = user_data['dietary_restrictions']
-        body_fat = user_data['body_fat_percentage']
-        diabetes = user_data['diabetes_type']
-        target_cal = user_data['target_calories']
-        target_carbs = user_data['target_carbs']
-        target_protein = user_data['target_protein']
-        target_fat = user_data['target_fat']
-        
-        # 安全地格式化字串
-        diabetes_context = f"糖尿病類型：{diabetes}" if diabetes else "無糖尿病"
-        
-        user_context = f"""
-用戶資料：{name}，{age}歲，{gender}
-身高：{height}cm，體重：{weight}kg，體脂率：{body_fat:.1f}%
-活動量：{activity}
-健康目標：{goals}
-飲食限制：{restrictions}
-{diabetes_context}
-
-每日營養目標：
-熱量：{target_cal:.0f}大卡，碳水：{target_carbs:.0f}g，蛋白質：{target_protein:.0f}g，脂肪：{target_fat:.0f}g
-
-最近3天飲食：
-{chr(10).join([f"- {meal[0]}" for meal in recent_meals[:5]])}
-
-常吃食物：
-{chr(10).join([f"- {pref[0]} (吃過{pref[1]}次)" for pref in food_preferences[:5]])}
-
-用戶詢問：{user_message}
-"""
-        
-        # 修改後的建議 Prompt
-        suggestion_prompt = """
+# 飲食建議 Prompt（模組層級常數，只替換最近飲食記錄）
+SUGGESTION_PROMPT_TEMPLATE = """
 你是擁有20年經驗的專業營養師。請根據用戶的飲食習慣提供建議。
 
 重要原則：
@@ -3042,7 +2787,7 @@ def provide_meal_suggestions(event, user_message=""):
 3. 提供彈性的用餐建議
 
 根據用戶最近的實際飲食記錄：
-{chr(10).join([f"- {meal[0]}" for meal in recent_meals[:5]])}
+{recent_meals}
 
 請提供：
 🍽️ 適合現在吃的餐點選項（2-3個）
@@ -3060,391 +2805,314 @@ def provide_meal_suggestions(event, user_message=""):
 
 請提供實用建議，不要預設用戶的用餐時間表。
 """
-        
-        # 使用 OpenAI 生成建議
-        try:
-            from openai import OpenAI
-            client = OpenAI(api_key=OPENAI_API_KEY)
-            
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": suggestion_prompt},
-                    {"role": "user", "content": user_context}
-                ],
-                max_tokens=1200,
-                temperature=0.8
-            )
-            
-            suggestions = response.choices[0].message.content
-            
-        except Exception as openai_error:
-            suggestions = generate_detailed_meal_suggestions(user, recent_meals, food_preferences)
-        
-        line_bot_api.push_message(
-            event.source.user_id,
-            TextSendMessage(text=f"🍽️ 為你推薦的餐點：\n\n{suggestions}")
-        )
-        
-    except Exception as e:
-        error_message = f"抱歉，推薦功能出現問題：{str(e)}\n\n請稍後再試或直接詢問特定餐點建議。"
-        
-        line_bot_api.push_message(
-            event.source.user_id,
-            TextSendMessage(text=error_message)
-        )
 
-def provide_food_consultation(event, user_question):
-    """提供食物諮詢"""
+def provide_meal_suggestions(event, user_message=""):
+    """提供飲食建議"""
     user_id = event.source.user_id
-    user = UserManager.get_user(user_id)
+    # 用戶資料、最近飲食和偏好一次查詢取得
+    bundle = UserManager.get_suggestion_bundle(user_id)
     
-    try:
+    if not bundle.user:
         line_bot_api.reply_message(
             event.reply_token,
-            TextSendMessage(text="🤔 讓我分析一下這個問題...")
+            TextSendMessage(text="請先設定個人資料，我才能提供適合你的飲食建議喔！")
         )
-        
-        # 準備用戶背景資訊 - 安全處理資料
-        if user:
-            user_data = get_user_data(user)
-            name = user_data['name']
-            age = user_data['age']
-            gender = user_data['gender']
-            height = user_data['height']
-            weight = user_data['weight']
-            activity = user_data['activity_level']
-            goals = user_data['health_goals']
-            restrictions = user_data['dietary_restrictions']
-            body_fat = user_data['body_fat_percentage']
-            diabetes = user_data['diabetes_type']
-            
-            diabetes_context = f"糖尿病類型：{diabetes}" if diabetes else "無糖尿病"
-            user_context = f"""
-用戶資料：{name}，{age}歲，{gender}
-身高：{height}cm，體重：{weight}kg，體脂率：{body_fat:.1f}%
-活動量：{activity}
-健康目標：{goals}
-飲食限制：{restrictions}
-{diabetes_context}
-"""
-        else:
-            user_context = "用戶未設定個人資料，請提供一般性建議。"
-        
-        # 修改後的諮詢 Prompt
-        consultation_prompt = f"""
-你是擁有20年經驗的專業營養師，特別專精糖尿病醣類控制。請回答用戶關於食物的問題：
-
-{user_context}
-
-重要要求：如果涉及份量建議，必須提供明確的份量指示
-
-請使用以下份量參考：
-🍚 主食: 1碗飯 = 1拳頭 = 150-200g
-🥩 蛋白質: 1份肉類 = 1手掌大小厚度 = 100-120g  
-🥬 蔬菜: 1份 = 煮熟後100g = 生菜200g
-🥜 堅果: 1份 = 30g = 約1湯匙
-🥛 飲品: 1杯 = 250ml
+        return
+    
+    # OpenAI 呼叫需要數秒，交給背景執行緒處理，完成後再回覆結果，不佔住 webhook 執行緒
+    EXECUTOR.submit(_compute_and_push_suggestions, event, bundle.user, bundle.recent_meals, bundle.preferences, user_message)
 
-糖尿病患者特別考量：
-- 重點關注血糖影響
-- 提供GI值參考
-- 建議適合的食用時間
-- 給出血糖監測建議
+def _compute_and_push_suggestions(event, user, recent_meals, food_preferences, user_message):
+    """背景產生飲食建議並回覆用戶"""
+    user_id = event.source.user_id
+    try:
+        # 用戶背景描述依資料版本快取，只需補上最近飲食與詢問內容
+        recent_meals_text = chr(10).join([f"- {meal[0]}" for meal in recent_meals[:5]])
+        user_context = get_profile_context(user_id, 'suggest') + f"""
+最近3天飲食：
+{recent_meals_text}
 
-請提供：
-1. 直接回答用戶的問題（可以吃/不建議/適量等）
-2. 說明原因（營養成分、健康影響）  
-3. 如果可以吃，明確建議份量：
-   - 具體重量（克數）
-   - 視覺比對（拳頭/手掌/湯匙等）
-   - 建議頻率（每天/每週幾次）
-   - 最佳食用時間
-4. 如果不建議，提供份量明確的替代選項
-5. 針對用戶健康狀況的特別提醒
+常吃食物：
+{chr(10).join([f"- {pref[0]} (吃過{pref[1]}次)" for pref in food_preferences[:5]])}
 
-請用專業但易懂的語言回應，讓用戶能精確執行建議。
+用戶詢問：{user_message}
 """
         
-        # 使用 OpenAI 分析
-        try:
-            from openai import OpenAI
-            client = OpenAI(api_key=OPENAI_API_KEY)
-            
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": consultation_prompt},
-                    {"role": "user", "content": f"用戶問題：{user_question}"}
-                ],
-                max_tokens=800,
-                temperature=0.7
-            )
-            
-            consultation_result = response.choices[0].message.content
-            
-        except Exception as openai_error:
-            consultation_result = generate_detailed_food_consultation(user_question, user)
+        suggestion_prompt = SUGGESTION_PROMPT_TEMPLATE.format(recent_meals=recent_meals_text)
         
-        line_bot_api.push_message(
-            event.source.user_id,
-            TextSendMessage(text=f"💡 營養師建議：\n\n{consultation_result}")
-        )
+        # 相同背景資料（含最近飲食）與相同詢問時直接使用快取
+        cache_key = prompt_cache_key("suggest", user_message, user_context)
+        suggestions = None if should_bypass_cache(user_message) else PROMPT_CACHE.get(cache_key)
         
-    except Exception as e:
-        error_message = f"抱歉，諮詢功能出現問題：{str(e)}\n\n請重新描述你的問題，我會盡力回答。"
+        prefix = "🍽️ 為你推薦的餐點：\n\n"
+        if suggestions is not None:
+            reply_or_push(event, TextSendMessage(text=f"{prefix}{suggestions}"))
+            return
         
-        line_bot_api.push_message(
-            event.source.user_id,
-            TextSendMessage(text=error_message)
-        )
-
-def analyze_food_description(event, food_description):
-    user_id = event.source.user_id
-    user = UserManager.get_user(user_id)
-    
-    try:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="🔍 正在分析你的飲食內容，請稍候...")
+        # 使用 OpenAI 串流生成建議：第一個段落先用 reply 送出，其餘內容完成後一次推播
+        suggestions = stream_to_line(
+            event, prefix,
+            lambda: generate_detailed_meal_suggestions(user, recent_meals, food_preferences),
+            model=CHAT_MODEL,
+            messages=[
+                {"role": "system", "content": suggestion_prompt},
+                {"role": "user", "content": user_context}
+            ],
+            max_tokens=800,
+            timeout=CHAT_REQUEST_TIMEOUT,
+            # 保留建議的多樣性，但收窄取樣範圍
+            temperature=0.7,
+            top_p=0.9
         )
         
-        # 判斷餐型
-        meal_type = determine_meal_type(food_description)
+        if suggestions is not None:
+            PROMPT_CACHE[cache_key] = suggestions
         
-        # 建立個人化提示 - 安全處理資料
-        if user:
-            user_data = get_user_data(user)
-            name = user_data['name']
-            age = user_data['age']
-            gender = user_data['gender']
-            height = user_data['height']
-            weight = user_data['weight']
-            activity = user_data['activity_level']
-            goals = user_data['health_goals']
-            restrictions = user_data['dietary_restrictions']
-            body_fat = user_data['body_fat_percentage']
-            diabetes = user_data['diabetes_type']
-            target_cal = user_data['target_calories']
-            target_carbs = user_data['target_carbs']
-            target_protein = user_data['target_protein']
-            target_fat = user_data['target_fat']
-            
-            diabetes_context = f"糖尿病類型：{diabetes}" if diabetes else "無糖尿病"
-            user_context = f"""
-用戶資料：
-- 姓名：{name}，{age}歲，{gender}
-- 身高：{height}cm，體重：{weight}kg，體脂率：{body_fat:.1f}%
-- 活動量：{activity}
-- 健康目標：{goals}
-- 飲食限制：{restrictions}
-- {diabetes_context}
-
-每日營養目標：
-熱量：{target_cal:.0f}大卡，碳水：{target_carbs:.0f}g，蛋白質：{target_protein:.0f}g，脂肪：{target_fat:.0f}g
-"""
-        else:
-            user_context = "用戶未設定個人資料，請提供一般性建議。"
+    except Exception as e:
+        error_message = f"抱歉，推薦功能出現問題：{str(e)}\n\n請稍後再試或直接詢問特定餐點建議。"
         
-        # 修改後的營養分析 Prompt
-        nutrition_prompt = f"""
-你是一位擁有20年經驗的專業營養師，特別專精糖尿病醣類控制。請根據用戶實際吃的食物進行分析。
+        reply_or_push(event, TextSendMessage(text=error_message))
 
-{user_context}
+# 相同輸入的 GPT 回答快取（24 小時），例如快速回覆按鈕送出的固定文字；
+# 問題先正規化（去除空白、標點並轉小寫）再組成 key，常見問題（如「糖尿病可以吃香蕉嗎？」）一天內都可重用
+PROMPT_CACHE = LockedTTLCache(maxsize=4096, ttl=86400)
 
-重要原則：
-1. 只分析用戶實際描述的食物，不要添加或建議其他餐點
-2. 對於常見食物要使用準確的營養數據
-3. 🔧 新增：份量預設規則
-   - 飲料類（豆漿、咖啡、奶茶、果汁等）：沒特別註明時以 330ml 計算
-   - 一般食物：沒特別註明時以 1份 計算
-   - 如果用戶有明確說明份量，則以用戶描述為準
-4. 使用純文字格式，多用表情符號
+# 比對問題時忽略空白、標點與大小寫，「香蕉可以吃嗎？」與「香蕉 可以吃嗎」共用同一筆快取
+_QUESTION_NORMALIZE_RE = re.compile(r'[\W_]+')
 
-🥛 飲料類（330ml基準）：
-• 豆漿：熱量132大卡，碳水13g，蛋白質9g，脂肪5g
-• 咖啡（黑咖啡）：熱量7大卡，碳水1g，蛋白質0g，脂肪0g
-• 拿鐵：熱量198大卡，碳水16g，蛋白質11g，脂肪11g
-• 奶茶：熱量231大卡，碳水35g，蛋白質7g，脂肪8g
-• 果汁：熱量145大卡，碳水36g，蛋白質1g，脂肪0g
+def normalize_question(question):
+    return _QUESTION_NORMALIZE_RE.sub('', question or '').lower()
 
-🍚 主食類（1份基準）：
-• 白飯1碗(150g)：熱量280大卡，碳水62g，蛋白質6g，脂肪1g
-• 糙米飯1碗(150g)：熱量220大卡，碳水45g，蛋白質5g，脂肪2g
-• 全麥吐司1片(30g)：熱量80大卡，碳水15g，蛋白質3g，脂肪1g
+def prompt_cache_key(fn, question, profile):
+    """以功能、正規化後的問題與用戶背景資料的 BLAKE2b 摘要作為快取 key"""
+    # orjson 直接輸出 UTF-8 bytes，不必再 encode，中文長字串的序列化也比 json 快
+    payload = orjson.dumps({"fn": fn, "q": normalize_question(question), "profile": profile}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(payload, digest_size=16).digest()
 
-🥩 蛋白質類（1份基準）：
-• 雞蛋1顆(50g)：熱量70大卡，碳水1g，蛋白質6g，脂肪5g
-• 雞胸肉1份(100g)：熱量165大卡，碳水0g，蛋白質31g，脂肪4g
-• 魚類1份(100g)：熱量140大卡，碳水0g，蛋白質26g，脂肪3g
+def should_bypass_cache(text):
+    """用戶要求「重新」回答時不使用快取"""
+    return '重新' in (text or '')
 
-🥬 蔬菜類（1份基準）：
-• 青菜1份(100g)：熱量25大卡，碳水5g，蛋白質3g，脂肪0g
-• 沙拉1份(150g)：熱量50大卡，碳水8g，蛋白質3g，脂肪1g
+class LLMCache:
+    """語意快取：問題的 embedding 與先前問題夠接近時，直接重用先前的回答
 
-🍎 水果類（1份基準）：
-• 香蕉1根(100g)：熱量90大卡，碳水23g，蛋白質1g，脂肪0g
-• 蘋果1個(150g)：熱量80大卡，碳水21g，蛋白質0g，脂肪0g
+    依 key（例如用戶背景資料）分組，只比對同一組內的問題，避免不同健康狀況的人拿到彼此的回答。
+    """
 
-份量判斷規則：
-- 如果用戶說「豆漿」沒特別說明 → 預設330ml
-- 如果用戶說「雞蛋」沒特別說明 → 預設1顆
-- 如果用戶說「飯」沒特別說明 → 預設1碗
-- 如果用戶明確說「豆漿1杯」→ 以250ml計算
-- 如果用戶明確說「雞蛋2顆」→ 以2顆計算
+    def __init__(self, threshold=0.92, max_keys=256, max_entries_per_key=32, ttl=86400):
+        self.threshold = threshold
+        self.max_entries_per_key = max_entries_per_key
+        self._entries = TTLCache(maxsize=max_keys, ttl=ttl)
+        self._lock = threading.Lock()
 
-請提供：
+    @staticmethod
+    def _normalize(vector):
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        # 以 float32 陣列儲存，記憶體約為 list 的四分之一
+        return array('f', (x / norm for x in vector))
+
+    def has_entries(self, key):
+        """這組 key 是否有快取的回答；沒有就不必為了比對而取得 embedding"""
+        with self._lock:
+            return bool(self._entries.get(key))
+
+    def lookup(self, key, vector):
+        """回傳相似度超過門檻的快取回答，沒有則回傳 None"""
+        query = self._normalize(vector)
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                return None
+            best_score, best_response = -1.0, None
+            for cached_vector, response in entries:
+                score = sum(map(operator.mul, query, cached_vector))  # 已正規化，內積即 cosine
+                if score > best_score:
+                    best_score, best_response = score, response
+        if best_score >= self.threshold:
+            print(f"🎯 語意快取命中（相似度 {best_score:.3f}）")
+            return best_response
+        return None
 
-請提供：
+    def add(self, key, vector, response):
+        entry = (self._normalize(vector), response)
+        with self._lock:
+            entries = self._entries.get(key) or []
+            entries.append(entry)
+            # 只保留最新的幾筆
+            self._entries[key] = entries[-self.max_entries_per_key:]
 
-🔍 實際攝取分析：
-只分析用戶描述的這一餐，包括：
-熱量：約XX大卡
-碳水化合物：XXg
-蛋白質：XXg
-脂肪：XXg
-纖維：XXg
+# 食物諮詢 Prompt（模組層級常數，只替換用戶背景資料）
+CONSULTATION_PROMPT_TEMPLATE = """
+你是擁有20年經驗的專業營養師，特別專精糖尿病醣類控制。請回答用戶關於食物的問題：
+
+{user_context}
+
+{portion_reference}{diabetes_guidance}請提供：
+1. 直接回答用戶的問題（可以吃/不建議/適量等）
+2. 說明原因（營養成分、健康影響）  
+3. 如果可以吃，明確建議份量：
+   - 具體重量（克數）
+   - 視覺比對（拳頭/手掌/湯匙等）
+   - 建議頻率（每天/每週幾次）
+   - 最佳食用時間
+4. 如果不建議，提供份量明確的替代選項
+5. 針對用戶健康狀況的特別提醒
 
-💡 這一餐評價：
-基於用戶健康目標評估這餐是否合適
-這餐的優點和可改進之處
-對血糖的影響（如有糖尿病）
+請用專業但易懂的語言回應，讓用戶能精確執行建議。回答請控制在400字以內。
+"""
 
-🍽️ 下次進食建議：
-當用戶想吃下一餐時的建議
-適合的食物類型和份量
-與這餐的營養互補
+# 份量參考表與糖尿病注意事項只在需要時附加，縮短 prompt 以加快首個 token
+CONSULTATION_PORTION_REFERENCE = """重要要求：如果涉及份量建議，必須提供明確的份量指示
 
-特別注意：
-不要建議用戶"今天還需要吃什麼來補足營養"
-不要假設一天必須吃三餐
-只針對實際吃的食物給建議
-尊重用戶的飲食節奏
-嚴格按照份量預設規則提供數據
-在分析中明確說明使用的份量假設
-確保營養數據的合理性
+請使用以下份量參考：
+🍚 主食: 1碗飯 = 1拳頭 = 150-200g
+🥩 蛋白質: 1份肉類 = 1手掌大小厚度 = 100-120g  
+🥬 蔬菜: 1份 = 煮熟後100g = 生菜200g
+🥜 堅果: 1份 = 30g = 約1湯匙
+🥛 飲品: 1杯 = 250ml
 
-請確保在回應中清楚標示各營養素的數值，格式如：熱量：300大卡，碳水化合物：45g
 """
-        
-        # 使用 OpenAI 分析
-        try:
-            from openai import OpenAI
-            client = OpenAI(api_key=OPENAI_API_KEY)
-            
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",
-                messages=[
-                    {"role": "system", "content": nutrition_prompt},
-                    {"role": "user", "content": f"請分析以下{meal_type}：{food_description}"}
-                ],
-                max_tokens=1000,
-                temperature=0.7
-            )
-            
-            analysis_result = response.choices[0].message.content
-            
-            # 從分析結果中提取營養數據
-            nutrition_data = extract_nutrition_from_analysis(analysis_result)
-            
-            # 儲存飲食記錄（包含營養數據）
-            UserManager.save_meal_record(user_id, meal_type, food_description, analysis_result, nutrition_data)
-            
-            # 添加記錄確認訊息
-            confirmation_text = f"""
 
-✅ 已記錄你的{meal_type}
+CONSULTATION_DIABETES_GUIDANCE = """糖尿病患者特別考量：
+- 重點關注血糖影響
+- 提供GI值參考
+- 建議適合的食用時間
+- 給出血糖監測建議
 
-📝 記錄內容：{food_description}
-📊 營養數據：
-熱量：{nutrition_data.get('calories', 0):.0f} 大卡
-碳水：{nutrition_data.get('carbs', 0):.1f}g
-蛋白質：{nutrition_data.get('protein', 0):.1f}g
-脂肪：{nutrition_data.get('fat', 0):.1f}g
+"""
 
-💡 輸入「今日進度」可查看累計營養攝取"""
-            
-            # 組合完整回應
-            full_response = f"🍽️ {meal_type}營養分析：\n\n{analysis_result}{confirmation_text}"
-            
-        except Exception as openai_error:
-            analysis_result = f"OpenAI 分析暫時無法使用：{str(openai_error)}\n\n請確保 API 額度充足，或稍後再試。"
-            
-            # 使用基本營養數據
-            nutrition_data = {'calories': 300, 'carbs': 45, 'protein': 15, 'fat': 10, 'fiber': 5, 'sugar': 8}
-            
-            # 仍然儲存記錄
-            UserManager.save_meal_record(user_id, meal_type, food_description, analysis_result, nutrition_data)
-            
-            confirmation_text = f"""
+PORTION_QUESTION_KEYWORDS = ('份量', '多少', '幾克', '幾碗', '重量')
+
+# 個人資料設定流程不會填 diabetes_type，糖尿病狀況多半寫在問題、飲食限制或健康目標裡
+# （「血糖」也涵蓋「血糖值」）
+DIABETES_KEYWORDS = ('糖尿病', '血糖', '胰島素')
+
+def needs_diabetes_guidance(user_question, user_data):
+    """問題或用戶資料提到糖尿病／血糖時，諮詢 prompt 才需要附加糖尿病注意事項"""
+    texts = [user_question]
+    if user_data:
+        if user_data.diabetes_type:
+            return True
+        texts += [user_data.dietary_restrictions, user_data.health_goals]
+    return any(keyword in text for text in texts if text for keyword in DIABETES_KEYWORDS)
+
+def build_consultation_prompt(user_context, user_question, user_data):
+    """組合食物諮詢的 system prompt，只附加與問題相關的段落"""
+    asks_portion = any(keyword in user_question for keyword in PORTION_QUESTION_KEYWORDS)
+    has_diabetes = needs_diabetes_guidance(user_question, user_data)
+    return CONSULTATION_PROMPT_TEMPLATE.format(
+        user_context=user_context,
+        portion_reference=CONSULTATION_PORTION_REFERENCE if asks_portion else "",
+        diabetes_guidance=CONSULTATION_DIABETES_GUIDANCE if has_diabetes else ""
+    )
 
-✅ 已記錄你的{meal_type}
+# 食物諮詢的語意快取（「我可以吃巧克力嗎？」與「巧克力可以吃嗎」可共用同一個回答）
+CONSULTATION_CACHE = LLMCache(threshold=0.92)
+EMBEDDING_MODEL = "text-embedding-3-small"
 
-📝 記錄內容：{food_description}
-📊 使用預估營養數據
+def embed_text(text):
+    """取得文字的 embedding，失敗時回傳 None（不影響主要流程）"""
+    try:
+        return require_openai_client().embeddings.create(model=EMBEDDING_MODEL, input=text).data[0].embedding
+    except Exception as e:
+        print(f"⚠️ 取得 embedding 失敗：{e}")
+        return None
 
-💡 輸入「今日進度」可查看累計營養攝取"""
-            
-            full_response = f"{analysis_result}{confirmation_text}"
+def provide_food_consultation(event, user_question):
+    """提供食物諮詢"""
+    user_id = event.source.user_id
+    user = UserManager.get_user(user_id)
+    
+    try:
+        # 準備用戶背景資訊（依用戶資料版本快取）
+        user_context = get_profile_context(user_id, 'consult')
+        
+        user_data = get_user_data(user)
+        consultation_prompt = build_consultation_prompt(user_context, user_question, user_data)
+        
+        # 先查完全相同問題的快取，再查語意快取：同樣背景資料下問過相近的問題，就不必再呼叫 GPT
+        bypass_cache = should_bypass_cache(user_question)
+        cache_key = prompt_cache_key("consult", user_question, user_context)
+        consultation_result = None if bypass_cache else PROMPT_CACHE.get(cache_key)
+        # 語意快取有同組資料時才需要 embedding，空快取不多打一次 API、也不拖慢首個 token
+        question_embedding = None
+        if consultation_result is None and not bypass_cache and CONSULTATION_CACHE.has_entries(user_context):
+            question_embedding = embed_text(user_question)
+            if question_embedding is not None:
+                consultation_result = CONSULTATION_CACHE.lookup(user_context, question_embedding)
+        
+        prefix = "💡 營養師建議：\n\n"
+        if consultation_result is not None:
+            reply_or_push(event, TextSendMessage(text=f"{prefix}{consultation_result}"))
+            return
         
-        line_bot_api.push_message(
-            event.source.user_id,
-            TextSendMessage(text=full_response)
+        # 使用 OpenAI 串流分析：第一個段落先用 reply 送出，其餘內容完成後一次推播
+        consultation_result = stream_to_line(
+            event, prefix,
+            lambda: generate_detailed_food_consultation(user_question, user),
+            model=CHAT_MODEL,
+            messages=[
+                {"role": "system", "content": consultation_prompt},
+                {"role": "user", "content": f"用戶問題：{user_question}"}
+            ],
+            max_tokens=450,
+            timeout=CHAT_REQUEST_TIMEOUT,
+            # 固定輸出，讓相同問題的回答可以放心快取
+            temperature=0
         )
         
+        # 只快取 GPT 的回答，備用內容不放入快取；回答已送出，這時才取得存入語意快取用的 embedding
+        if consultation_result is not None:
+            PROMPT_CACHE[cache_key] = consultation_result
+            if question_embedding is None:
+                question_embedding = embed_text(user_question)
+            if question_embedding is not None:
+                CONSULTATION_CACHE.add(user_context, question_embedding, consultation_result)
+        
     except Exception as e:
-        error_message = f"抱歉，分析出現問題：{str(e)}\n\n請重新描述你的飲食內容。"
+        error_message = f"抱歉，諮詢功能出現問題：{str(e)}\n\n請重新描述你的問題，我會盡力回答。"
         
-        line_bot_api.push_message(
-            event.source.user_id,
-            TextSendMessage(text=error_message)
-        )
+        reply_or_push(event, TextSendMessage(text=error_message))
+
+# 營養數據提取：所有營養素合併成一個正則表達式，只需掃描文本一次
+# 有標籤的數值優先；沒有「熱量：」標籤時，才使用第一個「N 大卡」，
+# 沒有「碳水化合物：」時，才使用「碳水：」
+NUTRITION_RE = re.compile(
+    r'熱量[:：]\s*約?(?P<calories>\d+(?:\.\d+)?)\s*大卡'
+    r'|碳水化合物[:：]\s*約?(?P<carbs>\d+(?:\.\d+)?)\s*g'
+    r'|碳水[:：]\s*約?(?P<carbs_short>\d+(?:\.\d+)?)\s*g'
+    r'|蛋白質[:：]\s*約?(?P<protein>\d+(?:\.\d+)?)\s*g'
+    r'|脂肪[:：]\s*約?(?P<fat>\d+(?:\.\d+)?)\s*g'
+    r'|(?P<any_calories>\d+(?:\.\d+)?)\s*大卡'
+)
 
+# 提取不到時的預設值
+NUTRITION_EXTRACT_DEFAULTS = {'calories': 300, 'carbs': 45, 'protein': 15, 'fat': 10}
+
+# 次要群組 → 對應的營養素：只有主要標籤完全沒出現時才使用
+NUTRITION_FALLBACK_GROUPS = {'any_calories': 'calories', 'carbs_short': 'carbs'}
 
 def extract_nutrition_from_analysis(analysis_text):
     """從分析文本中提取營養數據"""
-    import re
-    
-    # 改進的正則表達式提取
-    calories_patterns = [
-        r'熱量[:：]\s*約?(\d+(?:\.\d+)?)\s*大卡',
-        r'總熱量[:：]\s*約?(\d+(?:\.\d+)?)\s*大卡',
-        r'(\d+(?:\.\d+)?)\s*大卡'
-    ]
-    
-    carbs_patterns = [
-        r'碳水化合物[:：]\s*約?(\d+(?:\.\d+)?)\s*g',
-        r'碳水[:：]\s*約?(\d+(?:\.\d+)?)\s*g'
-    ]
-    
-    protein_patterns = [
-        r'蛋白質[:：]\s*約?(\d+(?:\.\d+)?)\s*g'
-    ]
-    
-    fat_patterns = [
-        r'脂肪[:：]\s*約?(\d+(?:\.\d+)?)\s*g'
-    ]
-    
-    def extract_value(patterns, text, default=0):
-        for pattern in patterns:
-            match = re.search(pattern, text)
-            if match:
-                try:
-                    return float(match.group(1))
-                except:
-                    continue
-        return default
-    
-    calories = extract_value(calories_patterns, analysis_text, 300)
-    carbs = extract_value(carbs_patterns, analysis_text, 45)
-    protein = extract_value(protein_patterns, analysis_text, 15)
-    fat = extract_value(fat_patterns, analysis_text, 10)
+    found = {}
+    fallbacks = {}
+    for match in NUTRITION_RE.finditer(analysis_text):
+        group = match.lastgroup
+        if group in NUTRITION_FALLBACK_GROUPS:
+            fallbacks.setdefault(NUTRITION_FALLBACK_GROUPS[group], float(match.group(group)))
+        elif group not in found:
+            found[group] = float(match.group(group))
+            if len(found) == len(NUTRITION_EXTRACT_DEFAULTS):
+                break
+    
+    for nutrient, value in fallbacks.items():
+        found.setdefault(nutrient, value)
     
     return {
-        'calories': calories,
-        'carbs': carbs,
-        'protein': protein,
-        'fat': fat,
+        'calories': found.get('calories', NUTRITION_EXTRACT_DEFAULTS['calories']),
+        'carbs': found.get('carbs', NUTRITION_EXTRACT_DEFAULTS['carbs']),
+        'protein': found.get('protein', NUTRITION_EXTRACT_DEFAULTS['protein']),
+        'fat': found.get('fat', NUTRITION_EXTRACT_DEFAULTS['fat']),
         'fiber': 5,  # 預設值
         'sugar': 8   # 預設值
     }
@@ -3459,7 +3127,7 @@ def get_daily_progress_summary(user_id):
     
     user_data = get_user_data(user)
     current_calories = daily_nutrition[3] or 0
-    target_calories = user_data['target_calories']
+    target_calories = user_data.target_calories
     
     remaining_calories = max(0, target_calories - current_calories)
     progress_percent = (current_calories / target_calories * 100) if target_calories > 0 else 0
@@ -3471,93 +3139,54 @@ def get_daily_progress_summary(user_id):
 
 可以說「今日進度」查看詳細營養追蹤！"""
 
-def generate_weekly_report(event):
-    user_id = event.source.user_id
-    user = UserManager.get_user(user_id)
-    
-    if not user:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="請先設定個人資料才能產生週報告。")
-        )
-        return
-    
-    # 取得本週飲食記錄
-    weekly_meals = UserManager.get_weekly_meals(user_id)
-    
-    if not weekly_meals:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="本週還沒有飲食記錄。開始記錄你的飲食，就能看到詳細報告了！")
-        )
-        return
-    
-    # 計算統計數據
-    unique_dates = set(meal[3][:10] for meal in weekly_meals)  # 取日期部分
-    record_days = len(unique_dates)
-    total_meals = len(weekly_meals)
-    
-    # 統計餐型分佈
-    meal_counts = {}
-    meal_details = []
-    for meal in weekly_meals:
-        meal_type = meal[0]
-        meal_desc = meal[1]
-        meal_date = meal[3][:10]  # 取日期
-        meal_time = meal[3][11:16]  # 取時間
-        
-        meal_counts[meal_type] = meal_counts.get(meal_type, 0) + 1
-        meal_details.append(f"{meal_date} {meal_time} {meal_type}：{meal_desc}")
-    
-    # 生成增強版報告
-    try:
-        from openai import OpenAI
-        client = OpenAI(api_key=OPENAI_API_KEY)
-        
-        # 準備詳細的飲食資料
-        meals_by_date = {}
-        for meal in weekly_meals:
-            date = meal[3][:10]
-            if date not in meals_by_date:
-                meals_by_date[date] = []
-            meals_by_date[date].append(f"{meal[0]}：{meal[1]}")
-        
-        meals_summary = ""
-        for date, meals in sorted(meals_by_date.items()):
-            meals_summary += f"\n📅 {date}：\n"
-            for meal in meals:
-                meals_summary += f"  • {meal}\n"
-        
-        # 安全取得用戶資料
-        user_data = get_user_data(user)
-        name = user_data['name']
-        age = user_data['age']
-        gender = user_data['gender']
-        height = user_data['height']
-        weight = user_data['weight']
-        activity = user_data['activity_level']
-        goals = user_data['health_goals']
-        restrictions = user_data['dietary_restrictions']
-        diabetes = user_data['diabetes_type']
-    
-        diabetes_context = f"糖尿病類型：{diabetes}" if diabetes else "無糖尿病"
-    
-        user_context = f"""
-用戶資料：{name}，{age}歲，{gender}
-身高：{height}cm，體重：{weight}kg
-活動量：{activity}
-健康目標：{goals}
-飲食限制：{restrictions}
-{diabetes_context}
+# 週報告送給 GPT 的飲食記錄長度上限
+WEEKLY_MEAL_DESC_MAX_CHARS = 80
+WEEKLY_SUMMARY_MAX_CHARS = 1500
 
-記錄期間：{record_days}天（共{total_meals}餐）
-餐型分佈：{dict(meal_counts)}
+# 比對重複餐點時忽略空白與標點
+_MEAL_NORMALIZE_RE = re.compile(r'[\s，,、。.!！~～]+')
 
-詳細飲食記錄：
-{meals_summary}
-"""
-        
-        report_prompt = """
+def summarize_weekly_meals(weekly_meals):
+    """整理本週飲食記錄給 GPT 分析
+
+    相同餐型與內容的餐點只列出第一次，其餘合併成「重複餐點 ×次數」；
+    每筆描述最多 80 字，整份摘要最多 1500 字。
+    """
+    meals_by_date = {}
+    repeat_counts = {}
+    first_seen = {}
+    for meal in weekly_meals:
+        meal_type, meal_desc, date = meal[0], meal[1], meal[3][:10]
+        key = (meal_type, _MEAL_NORMALIZE_RE.sub('', meal_desc.lower()))
+        if key in first_seen:
+            repeat_counts[key] = repeat_counts.get(key, 1) + 1
+            continue
+        if len(meal_desc) > WEEKLY_MEAL_DESC_MAX_CHARS:
+            meal_desc = meal_desc[:WEEKLY_MEAL_DESC_MAX_CHARS] + "…"
+        first_seen[key] = f"{meal_type}：{meal_desc}"
+        meals_by_date.setdefault(date, []).append(first_seen[key])
+    
+    lines = []
+    for date, meals in sorted(meals_by_date.items()):
+        lines.append(f"\n📅 {date}：")
+        lines.extend(f"  • {meal}" for meal in meals)
+    if repeat_counts:
+        lines.append("\n🔁 重複餐點：")
+        lines.extend(f"  • {first_seen[key]} ×{count}" for key, count in repeat_counts.items())
+    
+    # 超過上限時只保留前面的內容，並註明省略筆數
+    summary_lines = []
+    length = 0
+    for index, line in enumerate(lines):
+        if length + len(line) + 1 > WEEKLY_SUMMARY_MAX_CHARS:
+            omitted = sum(1 for rest in lines[index:] if rest.startswith("  •"))
+            summary_lines.append(f"…（其餘 {omitted} 筆省略）")
+            break
+        summary_lines.append(line)
+        length += len(line) + 1
+    return "\n".join(summary_lines) + "\n"
+
+WEEKLY_REPORT_PROMPT = """
 作為專業營養師，請為用戶生成飲食分析報告（即使記錄天數不滿7天）：
 
 重要原則：
@@ -3593,67 +3222,131 @@ def generate_weekly_report(event):
 
 請提供實用、正面、專業的建議，讓用戶感受到進步和鼓勵。
 """
+
+WEEKLY_REPORT_CONTEXT_TEMPLATE = """
+用戶資料：{name}，{age}歲，{gender}
+身高：{height}cm，體重：{weight}kg
+活動量：{activity}
+健康目標：{goals}
+飲食限制：{restrictions}
+{diabetes_context}
+
+記錄期間：{record_days}天（共{total_meals}餐）
+餐型分佈：{meal_counts}
+
+詳細飲食記錄：
+{meals_summary}
+"""
+
+def generate_weekly_report(event):
+    """產生週報告（在背景執行緒執行，GPT 較慢時 reply token 可能已逾時，一律經 reply_or_push 送出）"""
+    user_id = event.source.user_id
+    user = UserManager.get_user(user_id)
+    
+    if not user:
+        reply_or_push(event, TextSendMessage(text="請先設定個人資料才能產生週報告。"))
+        return
+    
+    # 取得本週飲食記錄
+    weekly_meals = UserManager.get_weekly_meals(user_id)
+    
+    if not weekly_meals:
+        reply_or_push(event, TextSendMessage(text="本週還沒有飲食記錄。開始記錄你的飲食，就能看到詳細報告了！"))
+        return
+    
+    # 計算統計數據：記錄日期與餐型分佈在同一次迴圈中完成
+    unique_dates = set()
+    meal_counts = {}
+    for meal in weekly_meals:
+        unique_dates.add(meal[3][:10])  # 取日期部分
+        meal_counts[meal[0]] = meal_counts.get(meal[0], 0) + 1
+    record_days = len(unique_dates)
+    total_meals = len(weekly_meals)
+    
+    # 餐型統計兩種報告都會用到，只組一次
+    meal_type_lines = [
+        f"• {meal_type}：{count} 次 ({count / total_meals * 100:.0f}%)\n"
+        for meal_type, count in meal_counts.items()
+    ]
+    
+    # 用戶資料在 try 之前取得：備用報告也需要 diabetes，不能因前面出錯而未定義
+    user_data = get_user_data(user)
+    diabetes = user_data.diabetes_type
+    
+    # 生成增強版報告
+    try:
+        # 準備詳細的飲食資料（重複餐點合併、長度截斷，減少送出的 token）
+        meals_summary = summarize_weekly_meals(weekly_meals)
         
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
+        diabetes_context = f"糖尿病類型：{diabetes}" if diabetes else "無糖尿病"
+    
+        user_context = WEEKLY_REPORT_CONTEXT_TEMPLATE.format(
+            name=user_data.name, age=user_data.age, gender=user_data.gender,
+            height=user_data.height, weight=user_data.weight,
+            activity=user_data.activity_level, goals=user_data.health_goals,
+            restrictions=user_data.dietary_restrictions,
+            diabetes_context=diabetes_context, record_days=record_days,
+            total_meals=total_meals, meal_counts=meal_counts,
+            meals_summary=meals_summary
+        )
+        
+        # 送到 GPT_BATCH 自己的執行緒池：本函式已在 EXECUTOR 上執行，
+        # 若丟回同一個池再等待結果，池滿時會互相卡住
+        report_future = GPT_BATCH.submit(
+            model=CHAT_MODEL,
             messages=[
-                {"role": "system", "content": report_prompt},
+                {"role": "system", "content": WEEKLY_REPORT_PROMPT},
                 {"role": "user", "content": user_context}
             ],
-            max_tokens=1200,
+            max_tokens=900,
+            timeout=CHAT_REQUEST_TIMEOUT,
             temperature=0.7
         )
         
-        ai_analysis = response.choices[0].message.content
-        
-        # 組合完整報告
-        final_report = f"""📊 飲食分析報告
+        # GPT 產生分析的同時先組好報告開頭與餐型統計（各段落先放進 list，最後一次 join）
+        report_parts = [f"""📊 飲食分析報告
 
 ⏰ 記錄期間：{record_days} 天
 🍽️ 總餐數：{total_meals} 餐
 📈 平均每日：{total_meals/record_days:.1f} 餐
 
 🥘 餐型統計：
-"""
+"""]
+        report_parts.extend(meal_type_lines)
         
-        for meal_type, count in meal_counts.items():
-            percentage = (count / total_meals * 100)
-            final_report += f"• {meal_type}：{count} 次 ({percentage:.0f}%)\n"
-        
-        final_report += f"\n{ai_analysis}\n\n💪 持續記錄飲食，讓我為你提供更準確的營養建議！"
+        # 逾時或失敗時由下方 except 改送備用報告
+        ai_analysis = report_future.result(timeout=CHAT_RESULT_TIMEOUT).choices[0].message.content
+        report_parts.append(f"\n{ai_analysis}\n\n💪 持續記錄飲食，讓我為你提供更準確的營養建議！")
+        final_report = "".join(report_parts)
         
     except Exception as e:
         print(f"AI分析失敗：{e}")
         
         # 備用詳細報告
-        final_report = f"""📊 飲食記錄分析報告
+        report_parts = [f"""📊 飲食記錄分析報告
 
 ⏰ 記錄期間：{record_days} 天
 🍽️ 總餐數：{total_meals} 餐
 📈 平均每日：{total_meals/record_days:.1f} 餐
 
 🥘 餐型統計：
-"""
-        
-        for meal_type, count in meal_counts.items():
-            percentage = (count / total_meals * 100)
-            final_report += f"• {meal_type}：{count} 次 ({percentage:.0f}%)\n"
-        
-        final_report += f"""
+"""]
+        report_parts.extend(meal_type_lines)
+        report_parts.append("""
 
 📅 最近記錄：
-"""
+""")
         
         # 顯示最近5筆記錄
         for meal in weekly_meals[:5]:
             date = meal[3][:10]
             time = meal[3][11:16]
-            final_report += f"• {date} {time} {meal[0]}：{meal[1][:30]}{'...' if len(meal[1]) > 30 else ''}\n"
+            report_parts.append(f"• {date} {time} {meal[0]}：{meal[1][:30]}{'...' if len(meal[1]) > 30 else ''}\n")
         
         if len(weekly_meals) > 5:
-            final_report += f"• 還有 {len(weekly_meals)-5} 筆記錄...\n"
+            report_parts.append(f"• 還有 {len(weekly_meals)-5} 筆記錄...\n")
         
-        final_report += f"""
+        report_parts.append(f"""
 
 💡 基於你的記錄建議：
 
@@ -3665,22 +3358,26 @@ def generate_weekly_report(event):
 - 持續記錄有助於了解飲食習慣
 - 試著增加蔬菜和蛋白質的攝取
 - 保持規律的用餐時間
-"""
+""")
         
         if diabetes:
-            final_report += "• 糖尿病患者建議少量多餐，注意血糖監測\n"
+            report_parts.append("• 糖尿病患者建議少量多餐，注意血糖監測\n")
         
-        final_report += f"""
+        report_parts.append("""
 🏆 很棒的開始！
 記錄飲食是健康管理的第一步，你已經在正確的道路上了！
 
-💪 繼續加油，我會陪伴你達成健康目標！"""
+💪 繼續加油，我會陪伴你達成健康目標！""")
+        final_report = "".join(report_parts)
     
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=final_report)
-    )
+    reply_or_push(event, TextSendMessage(text=final_report))
+
 
+# 個人資料頁的快速回覆按鈕
+_QR_PROFILE = QuickReply(items=[
+    QuickReplyButton(action=MessageAction(label="更新個人資料", text="更新個人資料")),
+    QuickReplyButton(action=MessageAction(label="今日進度", text="今日進度"))
+])
 
 def show_user_profile(event):
     user_id = event.source.user_id
@@ -3695,45 +3392,47 @@ def show_user_profile(event):
     
     user_data = get_user_data(user)
 
-    bmi = user_data['weight'] / ((user_data['height'] / 100) ** 2)
-    body_fat = user_data['body_fat_percentage']
+    bmi = user_data.bmi
     
-    profile_text = f"""👤 你的個人資料：
+    profile_parts = [f"""👤 你的個人資料：
 
-- 姓名：{user_data['name']}
-- 年齡：{user_data['age']} 歲  
-- 性別：{user_data['gender']}
-- 身高：{user_data['height']} cm
-- 體重：{user_data['weight']} kg
-- 體脂率：{user_data['body_fat_percentage']:.1f}%
+- 姓名：{user_data.name}
+- 年齡：{user_data.age} 歲  
+- 性別：{user_data.gender}
+- 身高：{user_data.height} cm
+- 體重：{user_data.weight} kg
+- 體脂率：{user_data.body_fat_percentage:.1f}%
 - BMI：{bmi:.1f}
-- 活動量：{user_data['activity_level']}
-- 健康目標：{user_data['health_goals']}
-- 飲食限制：{user_data['dietary_restrictions']}"""
+- 活動量：{user_data.activity_level}
+- 健康目標：{user_data.health_goals}
+- 飲食限制：{user_data.dietary_restrictions}"""]
     
-    if user_data['diabetes_type']:
-        profile_text += f"\n• 糖尿病類型：{user_data['diabetes_type']}"
+    if user_data.diabetes_type:
+        profile_parts.append(f"\n• 糖尿病類型：{user_data.diabetes_type}")
     
-    profile_text += f"""
+    profile_parts.append(f"""
 
 🎯 每日營養目標：
-- 熱量：{user_data['target_calories']:.0f} 大卡
-- 碳水：{user_data['target_carbs']:.0f} g
-- 蛋白質：{user_data['target_protein']:.0f} g
-- 脂肪：{user_data['target_fat']:.0f} g
+- 熱量：{user_data.target_calories:.0f} 大卡
+- 碳水：{user_data.target_carbs:.0f} g
+- 蛋白質：{user_data.target_protein:.0f} g
+- 脂肪：{user_data.target_fat:.0f} g
 
-💡 想要更新資料，請點選「更新個人資料」。"""
-    
-    quick_reply = QuickReply(items=[
-        QuickReplyButton(action=MessageAction(label="更新個人資料", text="更新個人資料")),
-        QuickReplyButton(action=MessageAction(label="今日進度", text="今日進度"))
-    ])
+💡 想要更新資料，請點選「更新個人資料」。""")
     
     line_bot_api.reply_message(
         event.reply_token,
-        TextSendMessage(text=profile_text, quick_reply=quick_reply)
+        TextSendMessage(text="".join(profile_parts), quick_reply=_QR_PROFILE)
     )
 
+# 使用說明的快速回覆按鈕
+_QR_INSTRUCTIONS = QuickReply(items=[
+    QuickReplyButton(action=MessageAction(label="今日進度", text="今日進度")),
+    QuickReplyButton(action=MessageAction(label="飲食建議", text="今天要吃什麼？")),
+    QuickReplyButton(action=MessageAction(label="食物諮詢", text="糖尿病可以吃燕麥嗎？")),
+    QuickReplyButton(action=MessageAction(label="記錄飲食", text="午餐吃了雞腿便當"))
+])
+
 def show_instructions(event):
     instructions = """📋 使用說明
 
@@ -3773,18 +3472,18 @@ def show_instructions(event):
 💡 小技巧：
 越詳細的描述，越準確的建議！"""
     
-    quick_reply = QuickReply(items=[
-        QuickReplyButton(action=MessageAction(label="今日進度", text="今日進度")),
-        QuickReplyButton(action=MessageAction(label="飲食建議", text="今天要吃什麼？")),
-        QuickReplyButton(action=MessageAction(label="食物諮詢", text="糖尿病可以吃燕麥嗎？")),
-        QuickReplyButton(action=MessageAction(label="記錄飲食", text="午餐吃了雞腿便當"))
-    ])
-    
     line_bot_api.reply_message(
         event.reply_token,
-        TextSendMessage(text=instructions, quick_reply=quick_reply)
+        TextSendMessage(text=instructions, quick_reply=_QR_INSTRUCTIONS)
     )
 
+# 圖片訊息引導的快速回覆按鈕
+_QR_IMAGE_GUIDE = QuickReply(items=[
+    QuickReplyButton(action=MessageAction(label="飲食建議", text="推薦健康餐點")),
+    QuickReplyButton(action=MessageAction(label="糖尿病諮詢", text="血糖高可以吃什麼？")),
+    QuickReplyButton(action=MessageAction(label="今日進度", text="今日進度"))
+])
+
 @handler.add(MessageEvent, message=ImageMessage)
 def handle_image_message(event):
     guide_text = """📸 感謝你上傳照片！
@@ -3807,24 +3506,28 @@ def handle_image_message(event):
 
 我會根據你的個人資料和體脂率提供最適合的建議！"""
     
-    quick_reply = QuickReply(items=[
-        QuickReplyButton(action=MessageAction(label="飲食建議", text="推薦健康餐點")),
-        QuickReplyButton(action=MessageAction(label="糖尿病諮詢", text="血糖高可以吃什麼？")),
-        QuickReplyButton(action=MessageAction(label="今日進度", text="今日進度"))
-    ])
-    
     line_bot_api.reply_message(
         event.reply_token,
-        TextSendMessage(text=guide_text, quick_reply=quick_reply)
+        TextSendMessage(text=guide_text, quick_reply=_QR_IMAGE_GUIDE)
     )
 
 def check_database_structure():
     """檢查並修正資料庫結構"""
     conn = None
     try:
-        conn = sqlite3.connect('nutrition_bot.db', timeout=20.0)
+        conn = get_db_connection(timeout=20.0)
         cursor = conn.cursor()
         
+        # 調整頁面大小為 8KB（只需執行一次，VACUUM 後才會生效）
+        cursor.execute("PRAGMA page_size")
+        if cursor.fetchone()[0] != DB_PAGE_SIZE:
+            # WAL 模式下無法變更頁面大小，需先切回 DELETE 模式
+            cursor.execute("PRAGMA journal_mode = DELETE")
+            cursor.execute(f"PRAGMA page_size = {DB_PAGE_SIZE}")
+            cursor.execute("VACUUM")
+            cursor.execute("PRAGMA journal_mode = WAL")
+            print(f"✅ 資料庫頁面大小已調整為 {DB_PAGE_SIZE}")
+        
         # 檢查 meal_records 表結構
         cursor.execute("PRAGMA table_info(meal_records)")
         meal_columns = [column[1] for column in cursor.fetchall()]
@@ -3855,30 +3558,31 @@ def check_database_structure():
         if conn:
             conn.close()    
 
+# 餐型關鍵字：(群組名稱, 餐型, 關鍵字)，依序比對，先符合的餐型優先
+MEAL_TYPE_KEYWORDS = (
+    ('breakfast', '早餐', ('早餐', '早上', '早飯', '晨間', 'morning')),
+    ('lunch', '午餐', ('午餐', '中午', '午飯', '中餐', 'lunch')),
+    ('dinner', '晚餐', ('晚餐', '晚上', '晚飯', '晚食', 'dinner')),
+    ('snack', '點心', ('點心', '零食', '下午茶', '宵夜', 'snack')),
+)
+
+# 所有餐型合併成一個具名群組的 regex，只需掃描描述一次；不必先 lower()
+MEAL_TYPE_RE = re.compile(
+    '|'.join(f"(?P<{group}>{'|'.join(map(re.escape, keywords))})" for group, _, keywords in MEAL_TYPE_KEYWORDS),
+    re.IGNORECASE
+)
+
 def determine_meal_type(description):
     """判斷餐型"""
-    description_lower = description.lower()
-    
-    if any(word in description_lower for word in ['早餐', '早上', '早飯', 'morning', '晨間']):
-        return '早餐'
-    elif any(word in description_lower for word in ['午餐', '中午', '午飯', 'lunch', '中餐']):
-        return '午餐'
-    elif any(word in description_lower for word in ['晚餐', '晚上', '晚飯', 'dinner', '晚食']):
-        return '晚餐'
-    elif any(word in description_lower for word in ['點心', '零食', '下午茶', 'snack', '宵夜']):
-        return '點心'
-    else:
-        return '餐點'
-
-def generate_detailed_meal_suggestions(user, recent_meals, food_preferences):
-    """API 不可用時的詳細餐點建議"""
-    
-    user_data = get_user_data(user)
-    health_goal = user_data['health_goals']
-    restrictions = user_data['dietary_restrictions']
-    diabetes_type = user_data['diabetes_type']
+    matched = {match.lastgroup for match in MEAL_TYPE_RE.finditer(description)}
+    if matched:
+        for group, meal_type, _ in MEAL_TYPE_KEYWORDS:
+            if group in matched:
+                return meal_type
+    return '餐點'
 
-    suggestions = f"""根據你的健康目標「{health_goal}」，推薦以下餐點：
+# API 不可用時的備用內容（模組層級範本，只替換變動的欄位）
+DETAILED_MEAL_SUGGESTION_TEMPLATE = """根據你的健康目標「{health_goal}」，推薦以下餐點：
 
 🥗 均衡餐點建議（含精確份量）：
 
@@ -3894,21 +3598,7 @@ def generate_detailed_meal_suggestions(user, recent_meals, food_preferences):
 • 生菜沙拉：2碗 = 約200g = 約30大卡
 • 全麥麵包：1片 = 約30g = 約80大卡
 • 堅果：1湯匙 = 約15g = 約90大卡
-總熱量：約365大卡"""
-    
-    if diabetes_type:
-        suggestions += f"""
-
-🩺 糖尿病專用餐點：
-
-選項3：低GI控糖餐
-• 燕麥：1/2碗 = 約50g乾重 = 約180大卡
-• 水煮蛋：2顆 = 約100g = 約140大卡
-• 花椰菜：1份 = 約150g = 約40大卡
-• 酪梨：1/4顆 = 約50g = 約80大卡
-總熱量：約440大卡，低GI值"""
-    
-    suggestions += f"""
+總熱量：約365大卡{diabetes_section}
 
 💡 份量調整原則：
 • 減重：減少主食至半碗（90g）
@@ -3918,23 +3608,19 @@ def generate_detailed_meal_suggestions(user, recent_meals, food_preferences):
 ⚠️ 飲食限制考量：{restrictions}
 
 詳細營養分析功能暫時無法使用，以上為精確份量建議。"""
-    
-    return suggestions
 
-def generate_detailed_food_consultation(question, user):
-    """API 不可用時的詳細食物諮詢"""
-    
-    diabetes_note = ""
-    if user:
-        user_data = get_user_data(user)
-        if user_data['diabetes_type']:
-            diabetes_note = f"\n🩺 糖尿病患者特別注意：由於你有{user_data['diabetes_type']}，建議特別注意血糖監測。"
-        else:
-            diabetes_note = ""
-    else:
-        diabetes_note = ""
-    
-    consultation = f"""關於你的問題「{question}」：
+DIABETES_MEAL_SUGGESTION_SECTION = """
+
+🩺 糖尿病專用餐點：
+
+選項3：低GI控糖餐
+• 燕麥：1/2碗 = 約50g乾重 = 約180大卡
+• 水煮蛋：2顆 = 約100g = 約140大卡
+• 花椰菜：1份 = 約150g = 約40大卡
+• 酪梨：1/4顆 = 約50g = 約80大卡
+總熱量：約440大卡，低GI值"""
+
+DETAILED_FOOD_CONSULTATION_TEMPLATE = """關於你的問題「{question}」：
 
 💡 一般建議與份量指示：
 
@@ -3967,32 +3653,72 @@ def generate_detailed_food_consultation(question, user):
 • 定期監測血糖（糖尿病患者）
 
 詳細營養諮詢功能暫時無法使用，建議諮詢專業營養師獲得個人化建議。"""
+
+def generate_detailed_meal_suggestions(user, recent_meals, food_preferences):
+    """API 不可用時的詳細餐點建議"""
     
-    return consultation
+    user_data = get_user_data(user)
+    return DETAILED_MEAL_SUGGESTION_TEMPLATE.format_map({
+        'health_goal': user_data.health_goals,
+        'restrictions': user_data.dietary_restrictions,
+        'diabetes_section': DIABETES_MEAL_SUGGESTION_SECTION if user_data.diabetes_type else ""
+    })
+
+def generate_detailed_food_consultation(question, user):
+    """API 不可用時的詳細食物諮詢"""
+    
+    user_data = get_user_data(user) if user else None
+    diabetes_note = f"\n🩺 糖尿病患者特別注意：由於你有{user_data.diabetes_type}，建議特別注意血糖監測。" if user_data and user_data.diabetes_type else ""
+    
+    return DETAILED_FOOD_CONSULTATION_TEMPLATE.format_map({
+        'question': question,
+        'diabetes_note': diabetes_note
+    })
+
+# keep alive 共用同一個 Session，每次 ping 重用連線，不必重新 TCP/TLS 交握
+KEEP_ALIVE_SESSION = requests.Session()
 
 def keep_alive():
-    """保持服務活躍"""
-    while True:
-        try:
-            time.sleep(600)  # 等待10分鐘
-            # 請把下面的網址改成你的Render網址
-            requests.get("https://nutrition-linebot.onrender.com")
-            print("Keep alive ping sent")
-        except:
-            pass
+    """保持服務活躍（由排程器每10分鐘執行一次）"""
+    try:
+        # 請把下面的網址改成你的Render網址
+        KEEP_ALIVE_SESSION.head("https://nutrition-linebot.onrender.com", timeout=10)
+        print("Keep alive ping sent")
+    except requests.RequestException:
+        pass
 
 @app.route("/health", methods=['GET'])
 def health_check():
     return "OK", 200
 
 
-if __name__ == "__main__":
-    import os
+# 檢查是否在本地開發環境
+IS_LOCAL = os.getenv('RENDER') is None
 
-    # 檢查是否在本地開發環境
-    is_local = os.getenv('RENDER') is None
+def start_background_services():
+    """正式環境啟動排程器（包含 keep alive）並執行資料庫維護"""
+    start_scheduler()
+    check_database_structure()
+    startup_database_maintenance()
+    
+    test_nutrition_extraction()
+    print("啟動20年經驗糖尿病專業營養師機器人")
+    print("主要功能：")
+    print("- 體脂率精準計算與營養目標制定")
+    print("- 糖尿病醣類控制專業建議")
+    print("- 每日營養追蹤與進度顯示")
+    print("- 主動提醒與月度更新提醒")
+    print("- 每日使用報告Email發送")
+
+# 正式環境由 gunicorn 匯入 app:app，不會執行 __main__，所以在匯入時啟動背景服務；
+# Procfile 只開一個 worker（多執行緒），排程器與記憶體中的快取、對話狀態才會只有一份
+if not IS_LOCAL:
+    start_background_services()
+
+if __name__ == "__main__":
+    port = int(os.environ.get('PORT', 5000))
 
-    if is_local:
+    if IS_LOCAL:
         print("🔧 本地開發模式")
         print("📋 可用功能測試：")
         print("- 資料庫連線測試")
@@ -4000,26 +3726,10 @@ if __name__ == "__main__":
         print("- 基本功能測試")
         print()
         
-        # 只啟動基本服務，不啟動 keep_alive 和 scheduler
-        port = int(os.environ.get('PORT', 5000))
+        # 只啟動基本服務，不啟動 scheduler（含 keep alive）
         print(f"🚀 本地伺服器啟動在 http://localhost:{port}")
         app.run(host='127.0.0.1', port=port, debug=True)
     else:
-        # 啟動排程器
-        keep_alive_thread = threading.Thread(target=keep_alive)
-        keep_alive_thread.daemon = True
-        keep_alive_thread.start()
-        start_scheduler()
-        check_database_structure()
-        startup_database_maintenance()
-        
-        test_nutrition_extraction()
-        port = int(os.environ.get('PORT', 5000))
-        print(f"啟動20年經驗糖尿病專業營養師機器人在端口 {port}")
-        print("主要功能：")
-        print("- 體脂率精準計算與營養目標制定")
-        print("- 糖尿病醣類控制專業建議")
-        print("- 每日營養追蹤與進度顯示")
-        print("- 主動提醒與月度更新提醒")
-        print("- 每日使用報告Email發送")
-        app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
+        # 沒有透過 gunicorn 時的備用啟動方式：關閉 debug，避免 reloader 多開一個行程、重複啟動排程器
+        print(f"在端口 {port} 啟動")
+        app.run(host='0.0.0.0', port=port)
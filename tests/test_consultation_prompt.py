@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+
+import app
+
+
+def profile(diabetes_type=None, dietary_restrictions="無", health_goals="維持健康"):
+    return SimpleNamespace(
+        diabetes_type=diabetes_type,
+        dietary_restrictions=dietary_restrictions,
+        health_goals=health_goals,
+    )
+
+
+def test_diabetes_question_gets_guidance():
+    prompt = app.build_consultation_prompt("CTX", "我有糖尿病可以吃香蕉嗎", None)
+    assert app.CONSULTATION_DIABETES_GUIDANCE in prompt
+
+
+def test_blood_sugar_in_profile_gets_guidance():
+    prompt = app.build_consultation_prompt("CTX", "香蕉可以吃嗎", profile(health_goals="控制血糖"))
+    assert app.CONSULTATION_DIABETES_GUIDANCE in prompt
+
+    prompt = app.build_consultation_prompt("CTX", "香蕉可以吃嗎", profile(dietary_restrictions="糖尿病"))
+    assert app.CONSULTATION_DIABETES_GUIDANCE in prompt
+
+
+def test_diabetes_type_gets_guidance():
+    prompt = app.build_consultation_prompt("CTX", "香蕉可以吃嗎", profile(diabetes_type="第二型"))
+    assert app.CONSULTATION_DIABETES_GUIDANCE in prompt
+
+
+def test_unrelated_question_skips_optional_sections():
+    prompt = app.build_consultation_prompt("CTX", "香蕉可以吃嗎", profile())
+    assert app.CONSULTATION_DIABETES_GUIDANCE not in prompt
+    assert app.CONSULTATION_PORTION_REFERENCE not in prompt
+
+
+def test_portion_question_gets_portion_reference():
+    prompt = app.build_consultation_prompt("CTX", "一天可以吃多少香蕉", None)
+    assert app.CONSULTATION_PORTION_REFERENCE in prompt